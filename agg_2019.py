@@ -1,95 +1,147 @@
 import argparse as ap
-import multiprocessing as mp
+import glob
 import os
-import sys
 import time
 
-import pandas as pd
+from bins import TimeBins
+from main import DataProcessor, RunSettings, aggregate_partition, log_done, log_exception, log_quarantine
+from od import ODAccumulator
+from profiling import stage
+from shm import SharedColumns
+from util import DATA_DIR, AAM_DIR, ATM_DIR, OD_DIR, DIST_DIR, PARTIAL_DIR, parse_date_from_filename, \
+    filter_csv_file_by_range
 
-from main import DataProcessor
-from util import LOG_DIR, \
-    DATA_DIR, AAM_DIR, ATM_DIR, set_destination, parse_date_from_filename, \
-    get_csv_file_from_dir, filter_csv_file_by_time
 
-LOG = os.path.join(LOG_DIR, f'process-{int(time.time())}.log')
+def get_partial_key(location='Manhattan', bins: TimeBins = None, distributions=False):
+    # partials only combine with partials of the same location, bins and distributions
+    bins = TimeBins() if bins is None else bins
+    key = f'{location.replace(" ", "_")}-{bins.tag}'
+    return f'{key}-dist' if distributions else key
 
 
-def get_ndays_ntrips(data: pd.DataFrame, pickup: int, dropoff: int):
-    pickup = data.loc[:, 'PULocationID'] == pickup
-    dropoff = data.loc[:, 'DOLocationID'] == dropoff
-    selected = data.loc[pickup & dropoff]
-    day_lst = selected.tpep_pickup_datetime.apply(lambda x: x.day)
-    num_days = len(day_lst.unique())
-    num_trips = len(selected.index)
-    return num_days, num_trips
+def get_partial_path(name, **kwargs):
+    return os.path.join(PARTIAL_DIR, f'od-{name}-{get_partial_key(**kwargs)}.npz')
 
 
-def get_interarrival_time(data: pd.DataFrame, pickup: int, dropoff: int):
-    pickup = data.loc[:, 'PULocationID'] == pickup
-    dropoff = data.loc[:, 'DOLocationID'] == dropoff
-    selected = data.loc[pickup & dropoff]
-    trip_time = selected.trip_time
+def get_partial_files(start: str = None, end: str = None, **kwargs):
+    # partials on disk for get_partial_key(**kwargs), e.g. for a rollup of earlier runs
+    files = sorted(glob.glob(os.path.join(PARTIAL_DIR, f'od-*-{get_partial_key(**kwargs)}.npz')))
+    return filter_csv_file_by_range(files, start=start, end=end)
 
-    if len(trip_time) < 1:
-        return 0
-    return trip_time.mean()
 
-
-def aggregate_year_data(data_file, zone_file, pu_lst, weekday=True, start_time=0, location='Manhattan'):
+def get_month_name(data_file):
     try:
         year, month = parse_date_from_filename(data_file)
-        name = f'{year}-{month}'
+        return f'{year}-{month}'
     except ValueError:
-        name = data_file.split('/')[-1].split('.')[0]
+        return data_file.split('/')[-1].split('.')[0]
+
+
+def aggregate_month_data(data_file, zone_file, pu_lst, location='Manhattan', chunksize=0, bins=None,
+                         distributions=False, settings: RunSettings = None):
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_month_name(data_file)
 
-    wkd = 'wd' if weekday else 'wn'
-    data_path = os.path.join(RAW_DIR, data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
     zone_path = os.path.join(DATA_DIR, zone_file)
 
     try:
-        dp = DataProcessor(data=data_path, loc_zone=zone_path)
-        dp.filter_pickup_time(start=start_time, end=start_time+1)
+        if chunksize > 0:
+            dps = DataProcessor.iter_chunks(data_path, chunksize=chunksize, loc_zone=zone_path,
+                                            quarantine=settings.quarantine, cache=settings.cache)
+        else:
+            dps = [DataProcessor(data=data_path, loc_zone=zone_path, quarantine=settings.quarantine,
+                                 cache=settings.cache)]
+        acc = ODAccumulator(pu_lst, period=name, bins=bins, distributions=distributions)
+        quarantine = None
+        for dp in dps:
+            quarantine = dp.quarantine
+            dp.set_lazy()
+            dp.filter_pickup_location(location)
+            dp.filter_dropoff_location(location)
+            acc.update(dp.data)
+        log_quarantine(name, quarantine)
+    except Exception as err:
+        log_exception(name, err)
+        return
+    path = get_partial_path(name, location=location, bins=bins, distributions=distributions)
+    acc.save(path)
+    log_done(name, acc.n_trips.sum(), started)
+    return path
+
+
+def aggregate_month_shared(data_file, zone_file, pu_lst, pool, n_parts, location='Manhattan', bins=None,
+                           distributions=False, settings: RunSettings = None):
+    # aggregate_month_data with the cleaned month in shared memory, split into n_parts row ranges for the pool
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_month_name(data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
+    zone_path = os.path.join(DATA_DIR, zone_file)
+
+    try:
+        dp = DataProcessor(data=data_path, loc_zone=zone_path, lazy=True, quarantine=settings.quarantine,
+                           cache=settings.cache)
+        log_quarantine(name, dp.quarantine)
         dp.filter_pickup_location(location)
         dp.filter_dropoff_location(location)
-        dp.filter_weekday(weekend=not weekday)
+        with SharedColumns(dp.data, ODAccumulator.COL) as shared:
+            del dp
+            parts = pool.starmap(aggregate_partition, [(shared.spec, start, stop, pu_lst, name, bins, distributions,
+                                                        settings)
+                                                       for start, stop in shared.partitions(n_parts)])
+        acc = ODAccumulator.reduce(parts)
+        if acc is None:
+            acc = ODAccumulator(pu_lst, period=name, bins=bins, distributions=distributions)
     except Exception as err:
-        with open(LOG, 'a') as ff:
-            ff.write(f'{name}-{wkd}-{start_time}' + f'...{sys.exc_info()[0]}: {err}\n')
-        print(f'{name}-{wkd}-{start_time}' + f'...{sys.exc_info()[0]}: {err}')
-        return 0, 0, 0
-    else:
-        dat = dp.data
-        n_days = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-        n_trips = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-        atm = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-
-        for pu in pu_lst:
-            for do in pu_lst:
-                d, t = get_ndays_ntrips(dat, pu, do)
-                n_days.loc[pu, do] += d
-                n_trips.loc[pu, do] += t
-                atm.loc[pu, do] = get_interarrival_time(dat, pu, do)
-        return n_days, n_trips, atm
-
-
-def combine_results(res: list, pu_lst):
-    for w, wd_ in enumerate(['wd', 'wn']):
-        for hr_ in range(24):
-            ds = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-            ts = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-            atm = pd.DataFrame(index=pu_lst, columns=pu_lst, data=0)
-            for f_, ff in enumerate(files_19):
-                idx = f_ + hr_*len(files_19) + w*len(files_19)*24
-                d, t, a = res[idx]
-                ds += d
-                ts += t
-                atm += a
-            aam = 3600.*(ds.div(ts).fillna(0))
-            atm = atm.div(len(files_19))
-            aam.to_csv(os.path.join(AAM_DIR, f'aam-2019-{wd_}-{hr_}.csv'),
-                       na_rep='NA', line_terminator='\n')
-            atm.to_csv(os.path.join(ATM_DIR, f'atm-2019-{wd_}-{hr_}.csv'),
-                       na_rep='NA', line_terminator='\n')
+        log_exception(name, err)
+        return
+    path = get_partial_path(name, location=location, bins=bins, distributions=distributions)
+    acc.save(path)
+    log_done(name, acc.n_trips.sum(), started)
+    return path
+
+
+def combine_results(partials: list, name='2019', sparse=False, bins: TimeBins = None):
+    # bins, when given, is a coarser binning than the partials', which every month is summed into
+    # before the months are merged; the trips are not read again. Returns the files written
+    with stage('combine'):
+        if bins is None:
+            acc = ODAccumulator.reduce(ODAccumulator.load(ff) for ff in partials)
+        else:
+            acc = ODAccumulator.reduce(ODAccumulator.load(ff).coarsen(bins) for ff in partials)
+    if acc is None:
+        return []
+    if acc.bins != TimeBins():
+        name = f'{name}-{acc.bins.tag}'
+    files = []
+    for d, t, wd_, hr_ in acc.slices():
+        if acc.distributions:
+            dist = acc.to_distributions(d, t)
+            files.append(os.path.join(DIST_DIR, f'dist-{name}-{wd_}-{hr_}.csv'))
+            with stage('write', rows_in=len(dist.index)):
+                dist.to_csv(files[-1], index=False, line_terminator='\n')
+        if sparse:
+            od = acc.to_sparse(d, t)
+            files.append(os.path.join(OD_DIR, f'od-{name}-{wd_}-{hr_}.csv'))
+            with stage('write', rows_in=len(od)):
+                od.to_csv(files[-1])
+            continue
+        ds, ts, atm = acc.od_counts(d, t)
+        aam = 3600.*(ds.div(ts).fillna(0))
+        files += [os.path.join(AAM_DIR, f'aam-{name}-{wd_}-{hr_}.csv'),
+                  os.path.join(ATM_DIR, f'atm-{name}-{wd_}-{hr_}.csv')]
+        with stage('write', rows_in=len(aam.index)):
+            aam.to_csv(files[-2], na_rep='NA', line_terminator='\n')
+            atm.to_csv(files[-1], na_rep='NA', line_terminator='\n')
+    return files
+
+
+def parse_bins(text, holidays=None):
+    # '<MINUTES>:<DAYS>', e.g. '15:weekday'
+    minutes, _, days = text.partition(':')
+    return TimeBins(int(minutes), days or 'daytype', holidays=holidays)
 
 
 if __name__ == '__main__':
@@ -97,29 +149,28 @@ if __name__ == '__main__':
     par = ap.ArgumentParser(prog='data processor', description='CLI input to data processor')
     par.add_argument('--dest', nargs='?', metavar='<RAW DATA DIR>', type=str, default=None)
     par.add_argument('--dp_threads', nargs='?', metavar='<PROCESS THREADS>', type=int, default=2)
+    par.add_argument('--chunk', nargs='?', metavar='<CHUNK ROWS>', type=int, default=0)
+    par.add_argument('--year', nargs='?', metavar='<YEAR>', type=int, default=2019)
+    par.add_argument('--start', nargs='?', metavar='<YYYY-MM>', type=str, default=None)
+    par.add_argument('--end', nargs='?', metavar='<YYYY-MM>', type=str, default=None)
+    par.add_argument('--rollup', action='store_true', default=False, dest='rollup_only')
+    par.add_argument('--sparse', action='store_true', default=False, dest='sparse')
+    par.add_argument('--shm', action='store_true', default=False, dest='shared')
+    par.add_argument('--profile', action='store_true', default=False, dest='profile')
+    par.add_argument('--quarantine', action='store_true', default=False, dest='quarantine')
+    par.add_argument('--bins', nargs='?', metavar='<MINUTES:DAYS>', type=str, default='60:daytype')
+    par.add_argument('--coarsen', nargs='?', metavar='<MINUTES:DAYS,...>', type=str, default=None)
+    par.add_argument('--dist', action='store_true', default=False, dest='distributions')
+    par.add_argument('--holidays', nargs='?', metavar='<HOLIDAY FILE OR DATES>', type=str, default=None)
+    par.add_argument('--no-cache', action='store_false', default=True, dest='cache')
 
     arg = par.parse_args()
 
-    dest = arg.dest
-    RAW_DIR = set_destination(dest)
-
-    files_19 = get_csv_file_from_dir(RAW_DIR)
-    files_19 = filter_csv_file_by_time(files_19, year=2019)
-    zone_file_ = 'taxi+_zone_lookup.csv'
-    zone_table = pd.read_csv(os.path.join(DATA_DIR, zone_file_), low_memory=False, index_col=False)
-    zone_gp = zone_table.groupby(by='Borough').groups
-    for key in zone_gp:
-        zone_gp[key] = zone_table.loc[zone_gp[key], 'LocationID']
-
-    man_id = sorted(zone_gp['Manhattan'].values)
-
-    item = []
-    for wd in [True, False]:
-        for hr in range(24):
-            for f in files_19:
-                item.append((f, zone_file_, man_id, wd, hr))
-
-    with mp.Pool(arg.dp_threads) as pool:
-        results = pool.starmap(aggregate_year_data, item)
+    # the same run as pipeline.py's aggregate command
+    import pipeline
 
-    combine_results(results, man_id)
+    pipeline.run(pipeline.Config('aggregate', dest=arg.dest, threads=arg.dp_threads, chunk=arg.chunk,
+                                 year=arg.year, start=arg.start, end=arg.end, rollup=arg.rollup_only,
+                                 routine='shared' if arg.shared else 'month', sparse=arg.sparse,
+                                 quarantine=arg.quarantine, distributions=arg.distributions, profile=arg.profile,
+                                 bins=arg.bins, coarsen=arg.coarsen, holidays=arg.holidays, cache=arg.cache))
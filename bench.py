@@ -0,0 +1,223 @@
+import argparse as ap
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import agg_2019
+import cache
+import logger
+import main
+import util
+from cache import clear_cache
+from main import DataProcessor
+from od import ODAccumulator, od_matrices
+
+MANHATTAN = [4, 12, 13, 24, 41, 42, 43, 45, 48, 50, 68, 74, 75, 79, 87, 88, 90, 100, 103, 104, 105, 107, 113,
+             114, 116, 120, 125, 127, 128, 137, 140, 141, 142, 143, 144, 148, 151, 152, 153, 158, 161, 162, 163,
+             164, 166, 170, 186, 194, 202, 209, 211, 224, 229, 230, 231, 232, 233, 234, 236, 237, 238, 239, 243,
+             244, 246, 249, 261, 262, 263]
+BOROUGHS = ['Bronx', 'Brooklyn', 'EWR', 'Queens', 'Staten Island']
+# pickup, dropoff and distance column names of the TLC schemas DataProcessor.COL_MAP resolves; every schema
+# also gets PULocationID/DOLocationID, which the processing needs whatever the era
+SCHEMA = {'tpep': ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'trip_distance'],
+          'plain': [' pickup_datetime', ' dropoff_datetime', ' trip_distance'],
+          'trip': ['Trip_Pickup_DateTime', 'Trip_Dropoff_DateTime', 'Trip_Distance']}
+MONTH = '2019-03'
+ZONE_FILE = 'taxi+_zone_lookup.csv'
+GEN_CHUNK = 1000000
+
+
+def make_zone_table(path):
+    ids = np.arange(1, 266)
+    borough = np.array([BOROUGHS[i % len(BOROUGHS)] for i in range(len(ids))], dtype=object)
+    borough[np.isin(ids, MANHATTAN)] = 'Manhattan'
+    pd.DataFrame({'LocationID': ids, 'Borough': borough, 'Zone': 'zone',
+                  'service_zone': 'Yellow Zone'}).to_csv(path, index=False)
+
+
+def make_trips(n, rng, schema='tpep', month=MONTH):
+    # a month of trips, mostly inside Manhattan, with a few rows the cleaning filters drop
+    pickup_col, dropoff_col, distance_col = SCHEMA[schema]
+    start = pd.Timestamp(f'{month}-01').value // 10 ** 9
+    days = pd.Timestamp(f'{month}-01').days_in_month
+    pickup = start + rng.integers(0, days * 86400, n)
+    duration = rng.gamma(2., 450., n).astype('int64') + 30
+    duration[rng.random(n) < .005] = 5 * 3600
+    distance = np.round(duration / 3600. * rng.uniform(5, 20, n), 2)
+    distance[rng.random(n) < .005] = 0.
+    others = np.setdiff1d(np.arange(1, 266), MANHATTAN)
+    # demand is skewed towards a few zones, as in the real data
+    weight = 1. / np.arange(1, len(MANHATTAN) + 1)
+    zones = [np.where(rng.random(n) < .9, rng.choice(MANHATTAN, n, p=weight / weight.sum()), rng.choice(others, n))
+             for _ in range(2)]
+    return pd.DataFrame({'vendor_id': 1,
+                         pickup_col: pd.to_datetime(pickup, unit='s').strftime(DataProcessor.DATETIME_FORMAT),
+                         dropoff_col: pd.to_datetime(pickup + duration, unit='s').strftime(
+                             DataProcessor.DATETIME_FORMAT),
+                         'passenger_count': rng.integers(1, 5, n),
+                         distance_col: distance,
+                         'PULocationID': zones[0], 'DOLocationID': zones[1],
+                         'payment_type': 1, 'fare_amount': np.round(2.5 + 2.5 * distance, 2)})
+
+
+def make_month_file(path, n, schema='tpep', seed=0):
+    # written in blocks, so the larger scales never hold the whole month in memory
+    rng = np.random.default_rng(seed)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    for i, start in enumerate(range(0, n, GEN_CHUNK)):
+        make_trips(min(GEN_CHUNK, n - start), rng, schema).to_csv(tmp_path, index=False, mode='w' if i == 0 else 'a',
+                                                                  header=i == 0)
+    os.replace(tmp_path, path)
+
+
+def prepare(work_dir, n, schema, regen=False):
+    case_dir = os.path.join(work_dir, f'{schema}-{n}')
+    for d in ['raw', 'aam', 'atm', 'partial', 'cache', 'logs']:
+        if not os.path.exists(os.path.join(case_dir, d)):
+            os.makedirs(os.path.join(case_dir, d))
+    if regen or not os.path.isfile(os.path.join(case_dir, ZONE_FILE)):
+        make_zone_table(os.path.join(case_dir, ZONE_FILE))
+    data_file = f'yellow_tripdata_{MONTH}.csv'
+    if regen or not os.path.isfile(os.path.join(case_dir, 'raw', data_file)):
+        make_month_file(os.path.join(case_dir, 'raw', data_file), n, schema)
+    return case_dir, data_file
+
+
+def use_dirs(case_dir):
+    # point the processing modules at the case's files, including the cache and the logs, so a run leaves nothing
+    # in the repo's data/ and logs/
+    for mod in (main, agg_2019):
+        mod.RAW_DIR = os.path.join(case_dir, 'raw')
+        mod.DATA_DIR = case_dir
+        mod.AAM_DIR = os.path.join(case_dir, 'aam')
+        mod.ATM_DIR = os.path.join(case_dir, 'atm')
+    agg_2019.PARTIAL_DIR = os.path.join(case_dir, 'partial')
+    cache.CACHE_DIR = util.CACHE_DIR = os.path.join(case_dir, 'cache')
+    logger.LOG = os.path.join(case_dir, 'logs', f'process-{int(time.time())}.log')
+    logger.BAD_LINE = os.path.join(case_dir, 'logs', f'bad_line-{int(time.time())}.log')
+    util.LOG = os.path.join(case_dir, 'logs', f'download-{int(time.time())}.log')
+    main.init()
+
+
+def timed(func, repeat=1):
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            wall = time.perf_counter() - start
+        best = wall if best is None else min(best, wall)
+    return best
+
+
+def run_case(case_dir, data_file, repeat=1):
+    use_dirs(case_dir)
+    data_path = os.path.join(case_dir, 'raw', data_file)
+    zone_path = os.path.join(case_dir, ZONE_FILE)
+    result = dict()
+
+    def ingest():
+        return DataProcessor(data=data_path, loc_zone=zone_path, cache=False)
+
+    result['ingest'] = timed(ingest, repeat)
+    dp = ingest()
+    for name, call in [('filter_pickup_location', lambda: dp.filter_pickup_location('Manhattan', inplace=False)),
+                       ('filter_dropoff_location', lambda: dp.filter_dropoff_location('Manhattan', inplace=False)),
+                       ('filter_pickup_time', lambda: dp.filter_pickup_time(8, 9, inplace=False)),
+                       ('filter_weekday', lambda: dp.filter_weekday(inplace=False)),
+                       ('filter_demand', lambda: dp.filter_demand(main.LOW_BD, inplace=False))]:
+        result[name] = timed(call, repeat)
+
+    manhattan = dp.filter_pickup_location('Manhattan', inplace=False)
+    manhattan.filter_dropoff_location('Manhattan')
+    one_slice = manhattan.filter_weekday(inplace=False)
+    one_slice.filter_pickup_time(8, 9)
+    one_slice.filter_demand(main.LOW_BD)
+    slice_data = one_slice.data
+    month_data = manhattan.data
+    result['od_matrices'] = timed(lambda: od_matrices(slice_data), repeat)
+    result['od_accumulate'] = timed(lambda: ODAccumulator(MANHATTAN).update(month_data), repeat)
+    del dp, manhattan, one_slice, slice_data, month_data
+
+    def cold(func):
+        # routines start from the CSV, not from a cache left by an earlier step
+        def call():
+            clear_cache(data_path)
+            func()
+        return call
+
+    result['data_process_routine'] = timed(cold(lambda: main.data_process_routine(
+        data_file, ZONE_FILE, True, 8)), repeat)
+    result['month_process_routine'] = timed(cold(lambda: main.month_process_routine(data_file, ZONE_FILE)), repeat)
+    result['aggregate_month_data'] = timed(cold(lambda: agg_2019.aggregate_month_data(
+        data_file, ZONE_FILE, MANHATTAN)), repeat)
+    partials = agg_2019.get_partial_files()
+    result['combine_results'] = timed(lambda: agg_2019.combine_results(partials, name='bench'), repeat)
+    clear_cache(data_path)
+    return result
+
+
+def compare(results, baseline):
+    for case, benches in results.items():
+        base = baseline.get(case, dict())
+        print(case)
+        for name, wall in benches.items():
+            if name in base and base[name] > 0:
+                print(f'    {name:<26}{wall:10.3f}s{base[name]:10.3f}s{wall / base[name]:8.2f}x')
+            else:
+                print(f'    {name:<26}{wall:10.3f}s{"-":>11}')
+
+
+if __name__ == '__main__':
+
+    par = ap.ArgumentParser(prog='benchmark', description='benchmarks on synthetic TLC-like trip files')
+    par.add_argument('--rows', nargs='?', metavar='<ROWS,...>', type=str, default='100000,1000000')
+    par.add_argument('--schema', nargs='?', metavar='<SCHEMA,...>', type=str, default='tpep')
+    par.add_argument('--repeat', nargs='?', metavar='<REPEAT>', type=int, default=1)
+    par.add_argument('--work_dir', nargs='?', metavar='<GENERATED DATA DIR>', type=str, default=None)
+    par.add_argument('--out', nargs='?', metavar='<RESULT JSON>', type=str, default=None)
+    par.add_argument('--baseline', nargs='?', metavar='<BASELINE JSON>', type=str, default=None)
+    par.add_argument('--regen', action='store_true', default=False, dest='regen')
+
+    arg = par.parse_args()
+
+    rows_ = [int(float(r)) for r in arg.rows.split(',')]
+    schemas_ = arg.schema.split(',')
+    for s_ in schemas_:
+        assert s_ in SCHEMA, f'Unknown schema: {s_}, must be in {list(SCHEMA.keys())}'
+    work_dir_ = arg.work_dir if arg.work_dir is not None else tempfile.mkdtemp(prefix='yc-bench-')
+    out_ = arg.out if arg.out is not None else os.path.join(work_dir_, f'bench-{int(time.time())}.json')
+
+    results_ = dict()
+    case_dirs_ = []
+    for s_ in schemas_:
+        for n_ in rows_:
+            case_dir_, data_file_ = prepare(work_dir_, n_, s_, regen=arg.regen)
+            case_dirs_.append(case_dir_)
+            results_[f'{s_}-{n_}'] = run_case(case_dir_, data_file_, repeat=arg.repeat)
+            print(f'{s_}-{n_}...done!')
+
+    with open(out_, 'w') as f:
+        json.dump({'meta': {'time': int(time.time()), 'python': platform.python_version(),
+                            'pandas': pd.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+                            'cpus': os.cpu_count()},
+                   'results': results_}, f, indent=1)
+
+    baseline_ = dict()
+    if arg.baseline is not None:
+        with open(arg.baseline, 'r') as f:
+            baseline_ = json.load(f)['results']
+    compare(results_, baseline_)
+    print(f'results...{out_}')
+    if arg.work_dir is None:
+        # the generated cases go, the results stay next to them
+        for case_dir_ in case_dirs_:
+            shutil.rmtree(case_dir_, ignore_errors=True)
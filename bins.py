@@ -0,0 +1,117 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+MINUTES_PER_DAY = 1440
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# day kind of a trip: its day of week, or HOLIDAY when its date is in the holiday calendar
+HOLIDAY = 7
+
+
+def read_holidays(holidays):
+    # a file with one date per line, or a comma-separated list of dates
+    if isinstance(holidays, str):
+        if os.path.isfile(holidays):
+            with open(holidays, 'r') as f:
+                holidays = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        else:
+            holidays = [h for h in holidays.split(',') if h.strip()]
+    return sorted({pd.Timestamp(h).strftime('%Y-%m-%d') for h in holidays})
+
+
+class TimeBins:
+    # how trips are binned in time: time of day in bins of minutes, and days grouped by 'daytype'
+    # (weekday/weekend), 'weekday' (one group per day of the week) or 'all'; holidays, when given,
+    # are taken out of their day of the week into a group of their own
+    DAYS = {'daytype': [('wd', range(0, 5)), ('wn', range(5, 7))],
+            'weekday': [(d, [i]) for i, d in enumerate(WEEKDAYS)],
+            'all': [('all', range(0, 7))]}
+
+    def __init__(self, minutes: int = 60, days: str = 'daytype', holidays=None):
+        assert isinstance(minutes, int) and 0 < minutes <= MINUTES_PER_DAY and MINUTES_PER_DAY % minutes == 0, \
+            f'invalid minutes={minutes}, must divide {MINUTES_PER_DAY}'
+        assert days in self.DAYS, f'Unknown days: {days}, must be in {list(self.DAYS.keys())}'
+        self.minutes = minutes
+        self.days = days
+        self.holidays = [] if holidays is None else read_holidays(holidays)
+        groups = list(self.DAYS[days])
+        if len(self.holidays) > 0:
+            groups.append(('hol', [HOLIDAY]))
+        self.day_labels = [label for label, _ in groups]
+        self._group = np.zeros(HOLIDAY + 1, dtype='int64')
+        for i, (_, kinds) in enumerate(groups):
+            self._group[list(kinds)] = i
+
+    @property
+    def n_times(self):
+        return MINUTES_PER_DAY // self.minutes
+
+    @property
+    def shape(self):
+        return len(self.day_labels), self.n_times
+
+    @property
+    def time_labels(self):
+        # the starting hour for whole-hour bins, as in the hourly file names, else e.g. '8h15'
+        starts = [t * self.minutes for t in range(self.n_times)]
+        if self.minutes % 60 == 0:
+            return [str(s // 60) for s in starts]
+        return [f'{s // 60}h{s % 60:02d}' for s in starts]
+
+    @property
+    def tag(self):
+        tag = f'{self.minutes}m-{self.days}'
+        return f'{tag}-hol' if len(self.holidays) > 0 else tag
+
+    def __eq__(self, other):
+        return isinstance(other, TimeBins) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'TimeBins({self.minutes}, {self.days!r}, holidays={len(self.holidays)})'
+
+    def to_dict(self):
+        return {'minutes': self.minutes, 'days': self.days, 'holidays': self.holidays}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(**json.loads(text))
+
+    def day_index(self, day):
+        # True/False for weekday/weekend, a day label, or a group position
+        if isinstance(day, (bool, np.bool_)):
+            day = 'wd' if day else 'wn'
+        if isinstance(day, str):
+            assert day in self.day_labels, f'Unknown day: {day}, must be in {self.day_labels}'
+            return self.day_labels.index(day)
+        assert 0 <= day < len(self.day_labels), f'invalid day={day}'
+        return int(day)
+
+    def locate(self, data, period: str = None):
+        # (day group, time bin) of every trip; holidays need the 'YYYY-MM' period the pickup days belong to
+        kind = np.asarray(data['pickup_weekday']).astype('int64')
+        if len(self.holidays) > 0:
+            assert period is not None, 'holidays need the period of the trips'
+            days = [int(h[8:]) for h in self.holidays if h[:7] == period]
+            kind = np.where(np.isin(np.asarray(data['pickup_day']), days), HOLIDAY, kind)
+        if self.minutes % 60 == 0:
+            time = np.asarray(data['pickup_hour']).astype('int64') // (self.minutes // 60)
+        else:
+            time = np.asarray(data['pickup_minute']).astype('int64') // self.minutes
+        return self._group[kind], time
+
+    def coarsen_map(self, coarse: 'TimeBins'):
+        # the coarse day group of every day group here; coarse bins must be unions of these bins
+        assert coarse.minutes % self.minutes == 0, f'{coarse.minutes} minute bins are not unions of {self.minutes}'
+        assert coarse.holidays == self.holidays, 'cannot change the holiday calendar by coarsening'
+        kinds = HOLIDAY + 1 if len(self.holidays) > 0 else HOLIDAY
+        group_map = np.zeros(len(self.day_labels), dtype='int64')
+        for i in range(len(self.day_labels)):
+            targets = np.unique(coarse._group[:kinds][self._group[:kinds] == i])
+            assert len(targets) == 1, f'day group {self.day_labels[i]} spans several groups of {coarse}'
+            group_map[i] = targets[0]
+        return group_map
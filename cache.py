@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from profiling import stage
+from util import CACHE_DIR
+
+META = 'meta.json'
+VERSION = 3
+
+
+def get_fingerprint(source):
+    stat = os.stat(source)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def get_cache_path(source, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    source = os.path.realpath(source)
+    key = hashlib.sha1(source.encode()).hexdigest()[:10]
+    return os.path.join(cache_dir, f'{os.path.basename(source)}-{key}')
+
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return
+
+
+def is_cached(source, columns=None, cache_dir=None, mode=None):
+    # mode is how the entry was cleaned, e.g. whether malformed rows were skipped; an entry of another mode is stale
+    meta = _read_meta(get_cache_path(source, cache_dir))
+    if meta is None or meta.get('version') != VERSION:
+        return False
+    if meta.get('source') != get_fingerprint(source) or meta.get('mode') != mode:
+        return False
+    if columns is not None and not set(columns).issubset(meta['columns']):
+        return False
+    return True
+
+
+def load_cache(source, columns=None, cache_dir=None, mode=None):
+    if not is_cached(source, columns, cache_dir, mode):
+        return
+    path = get_cache_path(source, cache_dir)
+    if columns is None:
+        columns = _read_meta(path)['columns']
+    try:
+        data = {c: np.load(os.path.join(path, f'{c}.npy')) for c in columns}
+    except OSError:
+        return
+    return pd.DataFrame(data, columns=columns)
+
+
+def iter_cache(source, columns=None, chunksize=1000000, cache_dir=None):
+    # the entry is memory-mapped, so only one chunk at a time is held in memory
+    path = get_cache_path(source, cache_dir)
+    meta = _read_meta(path)
+    if columns is None:
+        columns = meta['columns']
+    arrays = {c: np.load(os.path.join(path, f'{c}.npy'), mmap_mode='r') for c in columns}
+    for start in range(0, meta['rows'], chunksize):
+        with stage('read_cache') as record:
+            chunk = pd.DataFrame({c: np.array(arrays[c][start:start+chunksize]) for c in columns}, columns=columns)
+            record['rows_out'] = len(chunk.index)
+        yield chunk
+
+
+def save_cache(source, data: pd.DataFrame, columns=None, cache_dir=None, mode=None):
+    if columns is None:
+        columns = list(data.columns)
+    path = get_cache_path(source, cache_dir)
+    fingerprint = get_fingerprint(source)
+    # write into a private directory first so readers never see a half-written entry
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for c in columns:
+        np.save(os.path.join(tmp_path, f'{c}.npy'), data[c].to_numpy())
+    with open(os.path.join(tmp_path, META), 'w') as f:
+        json.dump({'version': VERSION, 'source': fingerprint, 'mode': mode, 'columns': columns,
+                   'rows': len(data.index)}, f)
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another worker stored the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+def clear_cache(source=None, cache_dir=None):
+    if source is not None:
+        shutil.rmtree(get_cache_path(source, cache_dir), ignore_errors=True)
+        return
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    for entry in os.listdir(cache_dir):
+        shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
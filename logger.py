@@ -0,0 +1,124 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+
+from util import LOG_DIR
+
+LOG = os.path.join(LOG_DIR, f'process-{int(time.time())}.log')
+BAD_LINE = os.path.join(LOG_DIR, f'bad_line-{int(time.time())}.log')
+# where each kind of record goes: the console as text, LOG as one JSON object per line, BAD_LINE as text
+ROUTES = {'done': ('console', 'log'),
+          'error': ('console', 'log'),
+          'quarantine': ('console', 'bad_line'),
+          'bad_line': ('bad_line',),
+          'progress': ('console',),
+          'info': ('console',)}
+# most records the listener takes off the queue for one write
+BATCH = 256
+
+_logger = logging.getLogger('tlc')
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+
+
+def to_json(record: logging.LogRecord):
+    return json.dumps({'time': record.created, 'pid': record.process, 'level': record.levelname,
+                       'kind': record.kind, 'msg': record.getMessage(), **record.fields}, default=str)
+
+
+class _Sink:
+    # writes a batch of records with one write per destination, opening files on their first record
+    def __init__(self, log_path=None, bad_line_path=None):
+        self.paths = {'log': LOG if log_path is None else log_path,
+                      'bad_line': BAD_LINE if bad_line_path is None else bad_line_path}
+        self.files = dict()
+
+    def write(self, records):
+        lines = {'console': [], 'log': [], 'bad_line': []}
+        for r in records:
+            for dest in ROUTES.get(r.kind, ('console', 'log')):
+                lines[dest].append(to_json(r) if dest == 'log' else r.getMessage())
+        if len(lines['console']) > 0:
+            sys.stdout.write(''.join(line + '\n' for line in lines['console']))
+            sys.stdout.flush()
+        for dest in ['log', 'bad_line']:
+            if len(lines[dest]) < 1:
+                continue
+            if dest not in self.files:
+                self.files[dest] = open(self.paths[dest], 'a')
+            self.files[dest].write(''.join(line + '\n' for line in lines[dest]))
+            self.files[dest].flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+
+
+class _Direct(logging.Handler):
+    # without a listener, records are written by the process logging them, as they come
+    def emit(self, record):
+        sink = _Sink()
+        try:
+            sink.write([record])
+        finally:
+            sink.close()
+
+
+def _listen(log_queue, log_path, bad_line_path, batch):
+    # until the None sentinel: block for a record, then take whatever else is queued, up to batch
+    sink = _Sink(log_path, bad_line_path)
+    stop = False
+    while not stop:
+        records = [log_queue.get()]
+        while len(records) < batch:
+            try:
+                records.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        stop = any(r is None for r in records)
+        sink.write([r for r in records if r is not None])
+    sink.close()
+
+
+def attach(log_queue=None):
+    # records of this process go to log_queue, never waiting on other processes, else are written directly
+    for handler in list(_logger.handlers):
+        _logger.removeHandler(handler)
+    _logger.addHandler(_Direct() if log_queue is None else logging.handlers.QueueHandler(log_queue))
+
+
+class Listener:
+    # the one process writing the records every process puts on its queue; workers attach(listener.queue)
+    def __init__(self, log_path=None, bad_line_path=None, batch=BATCH):
+        self.queue = mp.Queue()
+        args = (self.queue, LOG if log_path is None else log_path, BAD_LINE if bad_line_path is None else bad_line_path,
+                batch)
+        self._process = mp.Process(target=_listen, args=args, daemon=True)
+        self._process.start()
+        attach(self.queue)
+
+    def close(self):
+        # after every other process logging to the queue has exited
+        attach(None)
+        self.queue.put(None)
+        self._process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def log(kind, msg, level=logging.INFO, **fields):
+    # fields, e.g. rows and wall seconds, are kept as they are in the JSON records
+    _logger.log(level, msg, extra={'kind': kind, 'fields': fields})
+
+
+attach(None)
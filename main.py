@@ -1,5 +1,6 @@
 import argparse as ap
-import multiprocessing as mp
+import contextlib
+import logging
 import os
 import sys
 import time
@@ -8,19 +9,51 @@ from typing import Union
 import numpy as np
 import pandas as pd
 
-from util import download_file_parallel, LOG_DIR, \
-    DATA_DIR, AAM_DIR, ATM_DIR, set_destination, parse_date_from_filename, \
-    get_csv_file_from_dir, filter_csv_file_by_time, handle_parser_error, \
-    BadLineError, ColumnNotFoundError
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+from cache import is_cached, iter_cache, load_cache, save_cache
+import profiling
+from logger import log, attach
+from manifest import Manifest
+from profiling import profiled, stage
+from scheduler import Progress, file_cost
+from shm import SharedColumns, attach_columns
+from store import MatrixStore
+from zones import ZoneIndex, load_zone_index, register_zone_index
+from od import ODAccumulator, SparseOD, od_matrices
+from util import RAW_DIR, \
+    DATA_DIR, AAM_DIR, ATM_DIR, OD_DIR, DIST_DIR, parse_date_from_filename, handle_parser_error, \
+    BadLineError, ColumnNotFoundError, Quarantine, is_parquet, open_csv, find_long_line
 
 FILE = 'data/raw/yellow_tripdata_2019-12.csv'
 ZONE = 'data/taxi+_zone_lookup.csv'
-LOG = os.path.join(LOG_DIR, f'process-{int(time.time())}.log')
-BAD_LINE = os.path.join(LOG_DIR, f'bad_line-{int(time.time())}.log')
+MANIFEST = os.path.join(DATA_DIR, 'manifest.json')
+LOW_BD = 100
+# read_csv arguments that skip malformed rows and report each of them on stderr
+if tuple(int(v) for v in pd.__version__.split('.')[:2]) >= (1, 3):
+    SKIP_BAD_LINES = {'on_bad_lines': 'warn'}
+else:
+    SKIP_BAD_LINES = {'error_bad_lines': False, 'warn_bad_lines': True}
+
+
+def check_fields(file, source, check):
+    # raise on the first too long line, once the FieldCheck source has flagged one
+    if not check or not source.raw.long:
+        return
+    bad_line = find_long_line(file)
+    if bad_line is not None:
+        raise BadLineError(bad_line)
 
 
 class DataProcessor:
-    DTYPE = []
+    DTYPE = {'trip_distance': 'float32',
+             'PULocationID': 'float32',
+             'DOLocationID': 'float32'}
+    ZONE_DTYPE = 'uint16'
+    DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
     COL_MAP = {'pickup_datetime': 'tpep_pickup_datetime',
                ' pickup_datetime': 'tpep_pickup_datetime',
                'Trip_Pickup_DateTime': 'tpep_pickup_datetime',
@@ -33,21 +66,37 @@ class DataProcessor:
                ' Trip_Distance': 'trip_distance'}
     COL = ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'trip_distance',
            'PULocationID', 'DOLocationID']
+    # pickup_minute is the minute of the day, for bins finer than an hour
+    TIME_COL = ['pickup_hour', 'pickup_minute', 'pickup_weekday', 'pickup_day']
+    CACHE_COL = COL + ['trip_time'] + TIME_COL
+    # skip malformed rows into a Quarantine instead of raising BadLineError
+    QUARANTINE = False
 
     def __init__(self, data: Union[str, pd.DataFrame], **kwargs):
         assert isinstance(data, (str, pd.DataFrame)), f'invalid file type: {type(data)}, need \'str\' or \'dataframe\''
-        if isinstance(data, str):
-            try:
-                data_ = pd.read_csv(data, low_memory=False, index_col=False)
-            except pd.errors.ParserError as err:
-                bad_line = handle_parser_error(data, err)
-                raise BadLineError(bad_line)
-            else:
-                assert isinstance(data_, pd.DataFrame)
-                self._data = data_
+        self._source = data
+        self.quarantine = None
+        quarantine = kwargs.pop('quarantine', self.QUARANTINE)
+        if isinstance(quarantine, Quarantine):
+            # a block of iter_chunks, whose rows are quarantined with the rest of its file
+            self.quarantine, quarantine = quarantine, True
+        # rows with unreadable timestamps are dropped like any other invalid trip instead of failing the file
+        self._coerce = quarantine
+        use_cache = kwargs.pop('cache', True) and isinstance(data, str)
+        cached = None
+        if use_cache:
+            with stage('read_cache') as record:
+                cached = load_cache(data, columns=self.CACHE_COL, mode=self.cache_mode(quarantine))
+                record['rows_out'] = profiling.count_rows(cached)
+        if cached is not None:
+            self._data = cached
+        elif isinstance(data, str):
+            # Parquet is typed by column, it has no malformed lines to quarantine
+            self.quarantine = Quarantine(data) if quarantine and not is_parquet(data) else None
+            self._data = self._read_csv(data, quarantine=self.quarantine)
         else:
             self._data = data
-        self._raw = self._data.copy()
+        self._raw = self._data.copy() if kwargs.pop('keep_raw', False) else None
 
         try:
             self._loc_zone_table = kwargs.pop('loc_zone')
@@ -56,60 +105,318 @@ class DataProcessor:
         else:
             self._process_zone_table()
 
-        self._simple_process()
+        if cached is None and not kwargs.pop('processed', False):
+            self._simple_process()
+            if use_cache:
+                save_cache(data, self._data, columns=self.CACHE_COL, mode=self.cache_mode(quarantine))
+        if isinstance(data, str) and self.quarantine is not None:
+            self.quarantine.write()
+
+        # row filters recorded in lazy mode, applied together as one mask on the next read
+        self._lazy = kwargs.pop('lazy', False)
+        self._pending = []
+        self._indexed = False
+        if kwargs.pop('index', False):
+            self.build_index()
+
+    @staticmethod
+    def cache_mode(quarantine):
+        # what a cache entry was cleaned under: quarantine skips malformed rows and coerces bad timestamps
+        return {'quarantine': bool(quarantine), 'coerce': bool(quarantine)}
+
+    @classmethod
+    def resolve_column(cls, column):
+        return cls.COL_MAP.get(column, column.strip())
+
+    @classmethod
+    def _read_csv(cls, file, usecols=True, chunksize=None, quarantine: Quarantine = None):
+        # compressed csv is decompressed as the parser reads it, in the single and chunked reads alike
+        if is_parquet(file):
+            return cls._read_parquet(file, usecols, chunksize)
+        read_kw = dict(low_memory=False, index_col=False)
+        if quarantine is not None:
+            read_kw.update(SKIP_BAD_LINES, engine='c')
+        if usecols:
+            # only load the columns in COL, whatever name the file's schema gives them
+            with open_csv(file) as source:
+                header = pd.read_csv(source, nrows=0, index_col=False).columns
+            read_kw['usecols'] = [c for c in header if cls.resolve_column(c) in cls.COL]
+            read_kw['dtype'] = {c: cls.DTYPE[cls.resolve_column(c)] for c in read_kw['usecols']
+                                if cls.resolve_column(c) in cls.DTYPE}
+        # with usecols the parser silently truncates rows with too many fields: a quarantined read parses every
+        # column, for the parser to skip those rows, and keeps the wanted ones afterwards, while a strict read
+        # keeps usecols and counts the fields of each line as the parser reads it
+        columns = read_kw.pop('usecols', None) if quarantine is not None else None
+        check = 'usecols' in read_kw
+        if chunksize is not None:
+            return cls._iter_csv(file, quarantine, columns, check, chunksize=chunksize, **read_kw)
+        try:
+            with stage('read_csv') as record, open_csv(file, check) as source, \
+                    contextlib.nullcontext() if quarantine is None else quarantine.capture():
+                data_ = pd.read_csv(source, **read_kw)
+                record['rows_out'] = len(data_.index)
+                check_fields(file, source, check)
+        except pd.errors.ParserError as err:
+            bad_line = handle_parser_error(file, err)
+            raise BadLineError(bad_line)
+        except ValueError:
+            # a too long row can also shift a value into a column it does not convert to
+            bad_line = find_long_line(file) if check else None
+            if bad_line is None:
+                raise
+            raise BadLineError(bad_line)
+        assert isinstance(data_, pd.DataFrame)
+        return data_ if columns is None else data_.loc[:, columns]
+
+    @classmethod
+    def _read_parquet(cls, file, usecols=True, chunksize=None):
+        # Parquet needs pyarrow; with chunksize, the file is read one row batch at a time
+        assert pq is not None, f'reading {file} needs pyarrow'
+        parquet = pq.ParquetFile(file)
+        columns = None
+        if usecols:
+            columns = [c for c in parquet.schema_arrow.names if cls.resolve_column(c) in cls.COL]
+        if chunksize is not None:
+            return cls._iter_parquet(parquet.iter_batches(batch_size=chunksize, columns=columns))
+        with stage('read_parquet') as record:
+            data_ = cls._parquet_frame(parquet.read(columns=columns))
+            record['rows_out'] = len(data_.index)
+        return data_
+
+    @classmethod
+    def _iter_parquet(cls, batches):
+        while True:
+            with stage('read_parquet') as record:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                data_ = cls._parquet_frame(batch)
+                record['rows_out'] = len(data_.index)
+            yield data_
+
+    @classmethod
+    def _parquet_frame(cls, table):
+        data_ = table.to_pandas()
+        return data_.astype({c: cls.DTYPE[cls.resolve_column(c)] for c in data_.columns
+                             if cls.resolve_column(c) in cls.DTYPE})
+
+    @staticmethod
+    def _iter_csv(file, quarantine: Quarantine = None, columns=None, check=False, **read_kw):
+        try:
+            with open_csv(file, check) as source:
+                reader = iter(pd.read_csv(source, **read_kw))
+                while True:
+                    # time and capture only the parser's own work, not whatever runs between chunks
+                    with stage('read_csv') as record, \
+                            contextlib.nullcontext() if quarantine is None else quarantine.capture():
+                        chunk = next(reader, None)
+                        record['rows_out'] = 0 if chunk is None else len(chunk.index)
+                        check_fields(file, source, check)
+                    if chunk is None:
+                        break
+                    yield chunk if columns is None else chunk.loc[:, columns]
+        except pd.errors.ParserError as err:
+            bad_line = handle_parser_error(file, err)
+            raise BadLineError(bad_line)
+        except ValueError:
+            # a too long row can also shift a value into a column it does not convert to
+            bad_line = find_long_line(file) if check else None
+            if bad_line is None:
+                raise
+            raise BadLineError(bad_line)
+        if quarantine is not None:
+            quarantine.write()
+
+    @classmethod
+    def iter_chunks(cls, file: str, chunksize: int = 1000000, **kwargs):
+        # one cleaned DataProcessor per block of at most chunksize rows, read from the cache when possible
+        loc_zone = kwargs.pop('loc_zone', None)
+        strict = not kwargs.pop('quarantine', cls.QUARANTINE)
+        quarantine = Quarantine(file) if not strict and not is_parquet(file) else None
+        if kwargs.pop('cache', True) and is_cached(file, columns=cls.CACHE_COL, mode=cls.cache_mode(not strict)):
+            chunks, processed, quarantine = iter_cache(file, columns=cls.CACHE_COL, chunksize=chunksize), True, None
+        else:
+            chunks, processed = cls._read_csv(file, chunksize=chunksize, quarantine=quarantine), False
+        for chunk in chunks:
+            # the Quarantine is shared by every chunk, complete once the last one is read
+            if loc_zone is None:
+                dp = cls(chunk, processed=processed, quarantine=not strict if quarantine is None else quarantine)
+            else:
+                dp = cls(chunk, loc_zone=loc_zone, processed=processed,
+                         quarantine=not strict if quarantine is None else quarantine)
+                loc_zone = dp._loc_zone_table
+            yield dp
+
+    def get_zones(self, location: str):
+        assert hasattr(self, '_loc_zone_table'), 'Missing location zone file. Add it by using \'loc_zone\' argument.'
+        assert location in self._loc_zone_table.keys(), \
+            f'Unknown location: {location}, must be in {self._loc_zone_table.keys()}'
+        return list(self._loc_zone_table.zones(location))
 
     @property
     def data(self):
+        self._evaluate()
         return self._data.reset_index(drop=True)
 
+    @property
+    def lazy(self):
+        return self._lazy
+
+    def set_lazy(self, lazy: bool = True):
+        if not lazy:
+            self._evaluate()
+        self._lazy = lazy
+        return self
+
+    def _evaluate(self):
+        if len(self._pending) < 1:
+            return
+        with stage('evaluate', rows_in=len(self._data.index)) as record:
+            mask = np.ones(len(self._data.index), dtype=bool)
+            for predicate in self._pending:
+                mask &= np.asarray(predicate(self._data))
+            self._data = self._data.loc[mask]
+            self._pending = []
+            record['rows_out'] = len(self._data.index)
+
     @property
     def raw(self):
+        if self._raw is None:
+            if isinstance(self._source, str):
+                self._raw = self._read_csv(self._source, usecols=False)
+            else:
+                self._raw = self._source
         return self._raw
 
     def reset(self):
-        self._data = self._raw.copy()
+        self._data = self.raw.copy()
+        self._pending = []
+        self._indexed = False
+        self._simple_process()
+
+    def _wrap(self, data: pd.DataFrame):
+        # the frame is already clean, and still in index order unless the caller says otherwise
+        if hasattr(self, '_loc_zone_table'):
+            dp = DataProcessor(data=data, loc_zone=self._loc_zone_table, processed=True)
+        else:
+            dp = DataProcessor(data=data, processed=True)
+        dp._indexed = self._indexed
+        dp._lazy = self._lazy
+        return dp
 
     def _return(self, *args):
         assert len(args) > 0, 'expect at least 1 position argument'
         if len(args) == 1:
-            if hasattr(self, '_loc_zone_table'):
-                return DataProcessor(data=args[0], loc_zone=self._loc_zone_table)
-            else:
-                return DataProcessor(data=args[0])
+            return self._wrap(args[0])
         else:
-            if hasattr(self, '_loc_zone_table'):
-                return [DataProcessor(data=ag, loc_zone=self._loc_zone_table) for ag in args]
-            else:
-                return [DataProcessor(data=ag) for ag in args]
+            return [self._wrap(ag) for ag in args]
 
+    def build_index(self):
+        # sort by (weekend flag, hour, PU, DO); every order-preserving filter keeps the index valid
+        self._evaluate()
+        key = (self._data.pickup_weekday >= 5).astype('uint8') * 24 + self._data.pickup_hour
+        self._data = self._data.assign(slice_key=key.astype('uint8'))\
+            .sort_values(by=['slice_key', 'PULocationID', 'DOLocationID'], kind='mergesort')
+        self._indexed = True
+
+    @property
+    def indexed(self):
+        return self._indexed
+
+    def _slice_bounds(self):
+        return np.searchsorted(self._data.slice_key.to_numpy(), np.arange(2 * 24 + 1))
+
+    def _take_ranges(self, ranges):
+        parts = [self._data.iloc[a:b] for a, b in ranges if b > a]
+        if len(parts) < 1:
+            return self._data.iloc[0:0]
+        if len(parts) == 1:
+            return parts[0]
+        return pd.concat(parts)
+
+    def _take_slices(self, keys):
+        bounds = self._slice_bounds()
+        ranges = []
+        for k in sorted(keys):
+            if len(ranges) > 0 and ranges[-1][1] == bounds[k]:
+                ranges[-1] = (ranges[-1][0], bounds[k + 1])
+            else:
+                ranges.append((bounds[k], bounds[k + 1]))
+        return self._take_ranges(ranges)
+
+    def _take_pickup(self, location: int):
+        bounds = self._slice_bounds()
+        pu = self._data.PULocationID.to_numpy()
+        ranges = []
+        for k in range(2 * 24):
+            block = pu[bounds[k]:bounds[k + 1]]
+            ranges.append((bounds[k] + np.searchsorted(block, location, side='left'),
+                           bounds[k] + np.searchsorted(block, location, side='right')))
+        return self._take_ranges(ranges)
+
+    def get_slice(self, weekday: bool, hour: int):
+        assert self._indexed, 'build_index() first'
+        assert 0 <= hour < 24, f'invalid hour={hour}'
+        self._evaluate()
+        return self._return(self._take_slices([(0 if weekday else 1) * 24 + hour]))
+
+    def _to_datetime(self, column):
+        try:
+            return pd.to_datetime(self._data.loc[:, column], format=self.DATETIME_FORMAT)
+        except ValueError:
+            parsed = pd.to_datetime(self._data.loc[:, column], errors='coerce' if self._coerce else 'raise')
+            if self.quarantine is not None:
+                # the rows are still numbered as the parser returned them
+                self.quarantine.add_rows(self._data.index[parsed.isna() & self._data.loc[:, column].notna()])
+            return parsed
+
+    @profiled('process')
     def _simple_process(self):
-        self._data = self._data.rename(columns=self.COL_MAP)
+        self._data = self._data.rename(columns=self.resolve_column)
         for c in self.COL:
             if c not in self._data.columns:
                 raise ColumnNotFoundError(f'{c} not exist')
-        self._data.loc[:, 'tpep_pickup_datetime'] = pd.to_datetime(self.data.loc[:, 'tpep_pickup_datetime'])
-        self._data.loc[:, 'tpep_dropoff_datetime'] = pd.to_datetime((self.data.loc[:, 'tpep_dropoff_datetime']))
+        self._data.loc[:, 'tpep_pickup_datetime'] = self._to_datetime('tpep_pickup_datetime')
+        self._data.loc[:, 'tpep_dropoff_datetime'] = self._to_datetime('tpep_dropoff_datetime')
         self._data.loc[:, 'trip_time'] = (self._data.tpep_dropoff_datetime - self._data.tpep_pickup_datetime)\
-            .apply(lambda x: x.total_seconds())
+            .dt.total_seconds()
+        self._data = self._data.astype({'trip_distance': self.DTYPE['trip_distance']})
         self._data = self._data.loc[(self._data.trip_time > 60) & (self._data.trip_time < 7200)]
         self._data = self._data.loc[(self._data.trip_distance > 0.1) & (self._data.trip_distance < 20)]
+        self._data = self._data.dropna(subset=['PULocationID', 'DOLocationID'])
+        self._data = self._data.astype({'PULocationID': self.ZONE_DTYPE, 'DOLocationID': self.ZONE_DTYPE,
+                                        'trip_time': 'int32'})
+        pickup = self._data.tpep_pickup_datetime.dt
+        self._data = self._data.assign(pickup_hour=pickup.hour.astype('uint8'),
+                                       pickup_minute=(pickup.hour * 60 + pickup.minute).astype('uint16'),
+                                       pickup_weekday=pickup.weekday.astype('uint8'),
+                                       pickup_day=pickup.day.astype('uint8'))
 
     def _process_zone_table(self):
-        assert isinstance(self._loc_zone_table, (str, pd.DataFrame, dict)), \
-            f'invalid file type: {type(self._loc_zone_table)}, need \'str\', \'dataframe\', or \'dict\''
+        assert isinstance(self._loc_zone_table, (str, pd.DataFrame, dict, ZoneIndex)), \
+            f'invalid file type: {type(self._loc_zone_table)}, need \'str\', \'dataframe\', \'dict\' or \'ZoneIndex\''
         if isinstance(self._loc_zone_table, str):
-            self._loc_zone_table = pd.read_csv(self._loc_zone_table, low_memory=False, index_col=False)
-            assert isinstance(self._loc_zone_table, pd.DataFrame)
-        if isinstance(self._loc_zone_table, pd.DataFrame):
-            for c in ['LocationID', 'Borough']:
-                assert c in self._loc_zone_table.columns, f'{c} is not in the table'
-            groups = self._loc_zone_table.groupby(by='Borough').groups
-            for key in groups:
-                groups[key] = self._loc_zone_table.loc[groups[key], 'LocationID']
-            self._loc_zone_table = groups
-        assert isinstance(self._loc_zone_table, dict)
-
-    def _filter_location(self, location, column, **kwargs):
+            self._loc_zone_table = load_zone_index(self._loc_zone_table)
+        elif isinstance(self._loc_zone_table, pd.DataFrame):
+            self._loc_zone_table = ZoneIndex.from_table(self._loc_zone_table)
+        elif isinstance(self._loc_zone_table, dict):
+            self._loc_zone_table = ZoneIndex(self._loc_zone_table)
+
+    def _finish(self, filtered: pd.DataFrame, inplace: bool):
+        if not inplace:
+            return self._return(filtered)
+        self._data = filtered
+
+    def _filter(self, predicate, inplace: bool):
+        if not self._lazy:
+            return self._finish(self._data.loc[predicate(self._data)], inplace)
+        if not inplace:
+            dp = self._wrap(self._data)
+            dp._pending = self._pending + [predicate]
+            return dp
+        self._pending.append(predicate)
+
+    def _filter_location(self, location, column, inplace, **kwargs):
         assert column in self._data.columns, f'column not found: {column}'
         assert isinstance(location, (str, int)), \
             f'invalid \'location\' type: {type(location)}, need \'str\' or \'int\''
@@ -126,142 +433,432 @@ class DataProcessor:
 
             assert location in self._loc_zone_table.keys(), \
                 f'Unknown location: {location}, must be in {self._loc_zone_table.keys()}'
-            filtered = self._data.loc[self._data[column].isin(self._loc_zone_table[location])]
-        else:
-            if self._data[column].dtype == 'int64':
-                filtered = self._data.loc[self._data[column] == location]
-            else:
-                filtered = self._data.loc[self._data[column].astype('int64') == location]
-        return filtered
-
+            zone_index = self._loc_zone_table
+            return self._filter(lambda d: zone_index.mask(d[column], location), inplace)
+        if self._indexed and not self._lazy and column == 'PULocationID':
+            return self._finish(self._take_pickup(location), inplace)
+        if pd.api.types.is_integer_dtype(self._data[column].dtype):
+            return self._filter(lambda d: d[column] == location, inplace)
+        return self._filter(lambda d: d[column].astype('int64') == location, inplace)
+
+    @profiled()
     def filter_demand(self, low_bd: int, inplace: bool = True):
         assert isinstance(low_bd, int), f'invalid \'low_bd\' type: {type(low_bd)}, need \'int\''
+        self._evaluate()
         filtered = self._data.groupby(by='PULocationID').filter(lambda x: len(x.index) > low_bd)
-        if not inplace:
-            return self._return(filtered)
-        self._data = filtered
+        return self._finish(filtered, inplace)
 
+    @profiled()
     def filter_pickup_location(self, location: Union[str, int], inplace: bool = True, **kwargs):
-        filtered = self._filter_location(location, 'PULocationID', **kwargs)
-        if not inplace:
-            return self._return(filtered)
-        self._data = filtered
+        return self._filter_location(location, 'PULocationID', inplace, **kwargs)
 
+    @profiled()
     def filter_dropoff_location(self, location: Union[str, int], inplace: bool = True, **kwargs):
-        filtered = self._filter_location(location, 'DOLocationID', **kwargs)
-        if not inplace:
-            return self._return(filtered)
-        self._data = filtered
+        return self._filter_location(location, 'DOLocationID', inplace, **kwargs)
 
-    def filter_pickup_time(self, start: int, end: int, inplace: bool = True):
-        assert isinstance(start, int), f'invalid \'start\' type: {type(start)}'
-        assert isinstance(end, int), f'invalid \'end\' type: {type(end)}'
+    @profiled()
+    def filter_pickup_time(self, start: Union[int, float], end: Union[int, float], inplace: bool = True):
+        # hours of the day; fractions select by the pickup minute, e.g. start=8.25 for 08:15
+        assert isinstance(start, (int, float)), f'invalid \'start\' type: {type(start)}'
+        assert isinstance(end, (int, float)), f'invalid \'end\' type: {type(end)}'
         assert 0 <= start < end <= 24, f'invalid start={start} and end={end}'
 
-        hour_lst = self._data.loc[:, 'tpep_pickup_datetime'].apply(func=lambda x: x.hour)
-        filtered = self._data.loc[(hour_lst >= start) & (hour_lst < end)]
-        if not inplace:
-            return self._return(filtered)
-        self._data = filtered
+        if not isinstance(start, int) or not isinstance(end, int):
+            start, end = int(round(start * 60)), int(round(end * 60))
+            return self._filter(lambda d: (d.pickup_minute >= start) & (d.pickup_minute < end), inplace)
+        if self._indexed and not self._lazy:
+            filtered = self._take_slices([d * 24 + h for d in range(2) for h in range(start, end)])
+            return self._finish(filtered, inplace)
+        return self._filter(lambda d: (d.pickup_hour >= start) & (d.pickup_hour < end), inplace)
 
+    @profiled()
     def filter_weekday(self, weekend: bool = False, inplace: bool = True):
         assert isinstance(weekend, bool), f'invalid \'weekend\' type: {type(weekend)}'
 
-        day_lst = self._data.loc[:, 'tpep_pickup_datetime'].apply(func=lambda x: x.weekday())
+        if self._indexed and not self._lazy:
+            filtered = self._take_slices(range(24, 48) if weekend else range(24))
+            return self._finish(filtered, inplace)
         if weekend:
-            filtered = self._data.loc[day_lst >= 5]
-        else:
-            filtered = self._data.loc[day_lst < 5]
-        if not inplace:
-            return self._return(filtered)
-        self._data = filtered
+            return self._filter(lambda d: d.pickup_weekday >= 5, inplace)
+        return self._filter(lambda d: d.pickup_weekday < 5, inplace)
 
     def sort_by(self, by: str, ascending: bool = True, inplace: bool = True):
         assert isinstance(by, str), f'invalid \'by\' type: {type(by)}'
+        self._evaluate()
         sorted_ = self._data.sort_values(by=by, ascending=ascending)
         if not inplace:
-            return self._return(sorted_)
+            dp = self._return(sorted_)
+            dp._indexed = False
+            return dp
         self._data = sorted_
+        self._indexed = False
+
+
+class RunSettings:
+    # the options of one run, passed to its routines rather than set on the module, so that runs in one
+    # process, or tasks of different runs in one worker, do not overwrite each other's
+    def __init__(self, raw_dir=None, store_path=None, sparse=False, quarantine=False, distributions=False,
+                 profile_dir=None, cache=True):
+        self.raw_dir = RAW_DIR if raw_dir is None else raw_dir
+        self.store_path = store_path
+        self.sparse = sparse
+        self.quarantine = quarantine
+        # trip time and distance distributions per slice, from the accumulator routines
+        self.distributions = distributions
+        self.profile_dir = profile_dir
+        # read cleaned months from the cache and store them there
+        self.cache = cache
+        self._store = None
 
+    @property
+    def store(self):
+        # opened on first use in whichever process writes, once the parent has created or grown it
+        if self.store_path is not None and self._store is None:
+            self._store = MatrixStore(self.store_path, mode='r+')
+        return self._store
 
-def get_average_arrival_time(data: pd.DataFrame, pickup: int, dropoff: int):
-
-    pickup = data.loc[:, 'PULocationID'] == pickup
-    dropoff = data.loc[:, 'DOLocationID'] == dropoff
-    selected = data.loc[pickup & dropoff]
-    day_lst = selected.tpep_pickup_datetime.apply(lambda x: x.day)
-    num_days = len(day_lst.unique())
-    num_trips = len(selected.index)
-    if num_days > num_trips or num_trips < 1:
-        return np.nan
-    return 3600 * num_days / num_trips
-
-
-def get_interarrival_time(data: pd.DataFrame, aam: float, pickup: int, dropoff: int):
-    pickup = data.loc[:, 'PULocationID'] == pickup
-    dropoff = data.loc[:, 'DOLocationID'] == dropoff
-    selected = data.loc[pickup & dropoff]
-    trip_time = selected.trip_time
+    @property
+    def output_kind(self):
+        # slices written in one form are not up to date in the others
+        if self.sparse:
+            return 'sparse'
+        return 'csv' if self.store_path is None else 'store'
 
-    if np.isnan(aam) or len(trip_time) < 1:
-        return np.nan
-    return trip_time.mean()
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_store'] = None
+        return state
 
 
-def data_process_routine(data_file, zone_file, weekday=True, start_time=0, location='Manhattan'):
+def get_file_name(data_file):
     try:
         year, month = parse_date_from_filename(data_file)
         name = f'{year}-{month}'
     except ValueError:
         name = data_file.split('/')[-1].split('.')[0]
+    return name
+
+
+def log_exception(tag, err):
+    log('error', tag + f'...{sys.exc_info()[0]}: {err}', logging.ERROR, tag=tag, error=type(err).__name__)
+
+
+def log_bad_line(name, err):
+    log('bad_line', f'{name}-' + str(err).rstrip('\n'), logging.WARNING, tag=name)
+
+
+def log_quarantine(name, quarantine: Quarantine):
+    if quarantine is None or len(quarantine) < 1:
+        return
+    log('quarantine', f'{name}...{len(quarantine)} malformed lines quarantined in {quarantine.path}, '
+                      f'{len(quarantine.short)} of them short, {len(quarantine.unreadable)} with unreadable timestamps',
+        logging.WARNING, tag=name, lines=len(quarantine), short=len(quarantine.short),
+        unreadable=len(quarantine.unreadable), path=quarantine.path)
+
+
+def log_done(tag, rows, started):
+    # rows of the slice or month, and wall seconds since started (a time.perf_counter() value)
+    log('done', f'{tag}...done!', tag=tag, rows=int(rows), wall=time.perf_counter() - started)
+
+
+def write_od_matrices(dat: pd.DataFrame, name, wkd, start_time, settings: RunSettings):
+    if settings.sparse:
+        with stage('od', rows_in=len(dat.index)):
+            od = SparseOD.from_data(dat)
+        write_sparse(od, name, wkd, start_time, settings)
+        return
+    with stage('od', rows_in=len(dat.index)):
+        aam, iat = od_matrices(dat)
+    write_matrices(aam, iat, name, wkd, start_time, settings)
+
+
+def get_slice_outputs(name, wkd, start_time, settings: RunSettings):
+    if settings.sparse:
+        outputs = [os.path.join(OD_DIR, f'od-{name}-{wkd}-{start_time}.csv')]
+    else:
+        outputs = [os.path.join(AAM_DIR, f'aam-{name}-{wkd}-{start_time}.csv'),
+                   os.path.join(ATM_DIR, f'atm-{name}-{wkd}-{start_time}.csv')]
+    if settings.distributions:
+        outputs.append(os.path.join(DIST_DIR, f'dist-{name}-{wkd}-{start_time}.csv'))
+    return outputs
+
+
+@profiled('write')
+def write_matrices(aam: pd.DataFrame, iat: pd.DataFrame, name, wkd, start_time, settings: RunSettings):
+    if settings.store is not None:
+        settings.store.write(name, wkd == 'wd', start_time, aam, iat)
+        settings.store.flush()
+        return
+    aam_path, iat_path = get_slice_outputs(name, wkd, start_time, settings)[:2]
+    aam.to_csv(aam_path, na_rep='NA', line_terminator='\n')
+    iat.to_csv(iat_path, na_rep='NA', line_terminator='\n')
+
+
+def write_distributions(acc: ODAccumulator, name, wkd, start_time, settings: RunSettings, low_bd=None):
+    if not acc.distributions:
+        return
+    dist = acc.to_distributions(wkd == 'wd', start_time, low_bd=low_bd)
+    with stage('write', rows_in=len(dist.index)):
+        dist.to_csv(get_slice_outputs(name, wkd, start_time, settings)[-1], index=False, line_terminator='\n')
+
+
+def write_sparse(od: SparseOD, name, wkd, start_time, settings: RunSettings):
+    if settings.sparse:
+        with stage('write', rows_in=len(od)):
+            od.to_csv(get_slice_outputs(name, wkd, start_time, settings)[0])
+        return
+    aam, iat = od.od_matrices()
+    write_matrices(aam, iat, name, wkd, start_time, settings)
+
+
+def data_process_routine(data_file, zone_file, weekday=True, start_time=0, location='Manhattan', low_bd=LOW_BD,
+                         settings: RunSettings = None):
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_file_name(data_file)
     wkd = 'wd' if weekday else 'wn'
-    data_path = os.path.join(RAW_DIR, data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
     zone_path = os.path.join(DATA_DIR, zone_file)
     try:
-        dp = DataProcessor(data=data_path, loc_zone=zone_path)
+        dp = DataProcessor(data=data_path, loc_zone=zone_path, lazy=True, quarantine=settings.quarantine,
+                           cache=settings.cache)
+        log_quarantine(f'{name}-{wkd}-{start_time}', dp.quarantine)
         dp.filter_pickup_time(start=start_time, end=start_time+1)
         dp.filter_pickup_location(location)
         dp.filter_dropoff_location(location)
         dp.filter_weekday(weekend=not weekday)
-        dp.filter_demand(low_bd=100)
+        dp.filter_demand(low_bd=low_bd)
     except BadLineError as err:
-        lock.acquire()
-        with open(BAD_LINE, 'a') as f:
-            f.write(f'{name}-' + str(err))
-        lock.release()
+        log_bad_line(name, err)
     except Exception as err:
-        lock.acquire()
-        with open(LOG, 'a') as f:
-            f.write(f'{name}-{wkd}-{start_time}' + f'...{sys.exc_info()[0]}: {err}\n')
-        print(f'{name}-{wkd}-{start_time}' + f'...{sys.exc_info()[0]}: {err}')
-        lock.release()
+        log_exception(f'{name}-{wkd}-{start_time}', err)
     else:
-        dat = dp.data
-        pu_lst = dat.PULocationID.unique()
-        # do_lst = dat.DOLocationID.unique()
-        aam = pd.DataFrame(index=pu_lst, columns=pu_lst)
-        iat = pd.DataFrame(index=pu_lst, columns=pu_lst)
-        for pu in pu_lst:
-            for do in pu_lst:
-                aam.loc[pu, do] = get_average_arrival_time(dat, pu, do)
-                iat.loc[pu, do] = get_interarrival_time(dat, aam.loc[pu, do], pu, do)
-        aam = aam.sort_index(0)
-        aam = aam.reindex(sorted(aam.columns, key=lambda x: int(x)), axis=1)
-        iat = iat.sort_index(0)
-        iat = iat.reindex(sorted(iat.columns, key=lambda x: int(x)), axis=1)
-        aam.to_csv(os.path.join(AAM_DIR, f'aam-{name}-{wkd}-{start_time}.csv'),
-                   na_rep='NA', line_terminator='\n')
-        iat.to_csv(os.path.join(ATM_DIR, f'atm-{name}-{wkd}-{start_time}.csv'),
-                   na_rep='NA', line_terminator='\n')
-
-        lock.acquire()
-        print(f'{name}-{wkd}-{start_time}...done!')
-        lock.release()
-
-
-def init(lk):
-    global lock
-    lock = lk
+        data = dp.data
+        write_od_matrices(data, name, wkd, start_time, settings)
+        log_done(f'{name}-{wkd}-{start_time}', len(data.index), started)
+
+
+def month_process_routine(data_file, zone_file, location='Manhattan', low_bd=LOW_BD, settings: RunSettings = None):
+    # same outputs as data_process_routine over all 48 slices, but the file is read only once
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_file_name(data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
+    zone_path = os.path.join(DATA_DIR, zone_file)
+    try:
+        dp = DataProcessor(data=data_path, loc_zone=zone_path, lazy=True, quarantine=settings.quarantine,
+                           cache=settings.cache)
+        log_quarantine(name, dp.quarantine)
+        dp.filter_pickup_location(location)
+        dp.filter_dropoff_location(location)
+        dp.build_index()
+        dp.set_lazy(False)
+    except BadLineError as err:
+        log_bad_line(name, err)
+        return
+    except Exception as err:
+        log_exception(name, err)
+        return
+
+    for weekday in [True, False]:
+        wkd = 'wd' if weekday else 'wn'
+        for start_time in range(24):
+            try:
+                slice_dp = dp.get_slice(weekday, start_time)
+                slice_dp.filter_demand(low_bd=low_bd)
+            except Exception as err:
+                log_exception(f'{name}-{wkd}-{start_time}', err)
+            else:
+                data = slice_dp.data
+                write_od_matrices(data, name, wkd, start_time, settings)
+                log_done(f'{name}-{wkd}-{start_time}', len(data.index), started)
+
+
+def write_accumulated(acc: ODAccumulator, name, low_bd, settings: RunSettings, started):
+    # the 48 slices of a month's accumulator, as the accumulating routines write them
+    for weekday in [True, False]:
+        wkd = 'wd' if weekday else 'wn'
+        for start_time in range(24):
+            od = acc.to_sparse(weekday, start_time, low_bd=low_bd)
+            write_sparse(od, name, wkd, start_time, settings)
+            write_distributions(acc, name, wkd, start_time, settings, low_bd=low_bd)
+            log_done(f'{name}-{wkd}-{start_time}', od.n_trips.sum(), started)
+
+
+def stream_process_routine(data_file, zone_file, location='Manhattan', chunksize=1000000, low_bd=LOW_BD,
+                           settings: RunSettings = None):
+    # same outputs as month_process_routine, holding at most chunksize rows of the file in memory
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_file_name(data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
+    zone_path = os.path.join(DATA_DIR, zone_file)
+    try:
+        acc = None
+        for dp in DataProcessor.iter_chunks(data_path, chunksize=chunksize, loc_zone=zone_path,
+                                            quarantine=settings.quarantine, cache=settings.cache):
+            if acc is None:
+                acc = ODAccumulator(dp.get_zones(location), distributions=settings.distributions)
+            dp.set_lazy()
+            dp.filter_pickup_location(location)
+            dp.filter_dropoff_location(location)
+            acc.update(dp.data)
+    except BadLineError as err:
+        log_bad_line(name, err)
+        return
+    except Exception as err:
+        log_exception(name, err)
+        return
+    if acc is None:
+        return
+    log_quarantine(name, dp.quarantine)
+    write_accumulated(acc, name, low_bd, settings, started)
+
+
+def aggregate_partition(spec, start, stop, zones, period=None, bins=None, with_distributions=False,
+                        settings: RunSettings = None):
+    # a row range of the shared columns, as a partial accumulator; a pool worker may have run another run's
+    # task last, so profiling is set from this task's settings
+    profiling.enable(None if settings is None else settings.profile_dir)
+    with attach_columns(spec) as columns:
+        acc = ODAccumulator(zones, period=period, bins=bins, distributions=with_distributions)
+        return acc.update({c: a[start:stop] for c, a in columns.items()})
+
+
+def shared_process_routine(data_file, zone_file, pool, n_parts, location='Manhattan', low_bd=LOW_BD,
+                           settings: RunSettings = None):
+    # same outputs as month_process_routine; the month is cleaned here and put once into shared memory,
+    # and the pool aggregates n_parts row ranges of it as zero-copy views
+    settings = RunSettings() if settings is None else settings
+    started = time.perf_counter()
+    name = get_file_name(data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
+    zone_path = os.path.join(DATA_DIR, zone_file)
+    try:
+        dp = DataProcessor(data=data_path, loc_zone=zone_path, lazy=True, quarantine=settings.quarantine,
+                           cache=settings.cache)
+        log_quarantine(name, dp.quarantine)
+        dp.filter_pickup_location(location)
+        dp.filter_dropoff_location(location)
+        zones = dp.get_zones(location)
+        with SharedColumns(dp.data, ODAccumulator.COL) as shared:
+            del dp
+            parts = pool.starmap(aggregate_partition, [(shared.spec, start, stop, zones, name, None,
+                                                        settings.distributions, settings)
+                                                       for start, stop in shared.partitions(n_parts)])
+        acc = ODAccumulator.reduce(parts)
+    except BadLineError as err:
+        log_bad_line(name, err)
+        return
+    except Exception as err:
+        log_exception(name, err)
+        return
+    if acc is None:
+        return
+    write_accumulated(acc, name, low_bd, settings, started)
+
+
+def get_slice_entries(manifest: Manifest, data_file, zone_file, settings: RunSettings, location='Manhattan',
+                      low_bd=LOW_BD):
+    # (weekday, hour), manifest key, manifest entry and output files of every slice of data_file
+    name = get_file_name(data_file)
+    data_path = os.path.join(settings.raw_dir, data_file)
+    zone_path = os.path.join(DATA_DIR, zone_file)
+    entries = []
+    for weekday in [True, False]:
+        wkd = 'wd' if weekday else 'wn'
+        for start_time in range(24):
+            entry = manifest.entry(data_path, zone_path, location=location, low_bd=low_bd,
+                                   hour=start_time, daytype=wkd, output=settings.output_kind,
+                                   distributions=settings.distributions)
+            entries.append(((weekday, start_time), f'{name}-{wkd}-{start_time}', entry,
+                            get_slice_outputs(name, wkd, start_time, settings)))
+    return entries
+
+
+def get_stale_slices(manifest: Manifest, data_file, zone_file, settings: RunSettings, **kwargs):
+    store = settings.store
+    stale = []
+    for sl, key, entry, outputs in get_slice_entries(manifest, data_file, zone_file, settings, **kwargs):
+        if store is not None:
+            if not store.is_written(get_file_name(data_file), *sl) or manifest.is_stale(key, entry, []):
+                stale.append(sl)
+        elif manifest.is_stale(key, entry, outputs):
+            stale.append(sl)
+    return stale
+
+
+def record_slices(manifest: Manifest, data_file, zone_file, since, settings: RunSettings, **kwargs):
+    # only slices whose outputs were all rewritten after since are known to match their entry
+    store = settings.store
+    recorded = []
+    for sl, key, entry, outputs in get_slice_entries(manifest, data_file, zone_file, settings, **kwargs):
+        if store is not None:
+            if store.is_written(get_file_name(data_file), *sl):
+                manifest.record(key, entry)
+                recorded.append(key)
+        elif all(os.path.isfile(out) and os.path.getmtime(out) >= since for out in outputs):
+            manifest.record(key, entry)
+            recorded.append(key)
+    return recorded
+
+
+def get_task_cost(item, raw_dir=None):
+    # every task reads its whole month, so the file size stands for its cost
+    return file_cost(os.path.join(RAW_DIR if raw_dir is None else raw_dir, item[0]))
+
+
+def report_progress(progress: Progress):
+    log('progress', str(progress), done=progress.n_done, tasks=progress.n_tasks, eta=progress.eta)
+
+
+def process_as_downloaded(downloads, pool, routine, get_items, raw_dir=None):
+    # queue each file's tasks as soon as it lands; its download slot is freed once they all finish
+    pending = []
+    progress = Progress()
+    for name in downloads:
+        items = get_items(name)
+        if len(items) < 1:
+            downloads.release()
+            continue
+        left = [len(items)]
+        cost = get_task_cost(items[0], raw_dir)
+        progress.add(cost * len(items), len(items))
+
+        def task_done(_, left=left, cost=cost):
+            # callbacks run on the pool's single result thread
+            progress.done(cost)
+            report_progress(progress)
+            left[0] -= 1
+            if left[0] == 0:
+                downloads.release()
+
+        for it in items:
+            pending.append(pool.apply_async(routine, it, callback=task_done, error_callback=task_done))
+    for res in pending:
+        res.wait()
+
+
+def process_shared(pool, items, n_parts, progress: Progress, settings: RunSettings, **kwargs):
+    # months one after another, largest first, each spread over the whole pool
+    items = sorted(items, key=lambda it: get_task_cost(it, settings.raw_dir), reverse=True)
+    costs = [get_task_cost(it, settings.raw_dir) for it in items]
+    progress.add(sum(costs), len(items))
+    for it, cost in zip(items, costs):
+        shared_process_routine(*it, pool, n_parts, settings=settings, **kwargs)
+        progress.done(cost)
+        report_progress(progress)
+
+
+def get_location_zones(zone_file, location='Manhattan'):
+    return list(load_zone_index(os.path.join(DATA_DIR, zone_file)).zones(location))
+
+
+def init(log_queue=None, zone_file=None, zone_index=None):
+    # records go to the run's logger.Listener through log_queue, else are written by this process
+    attach(log_queue)
+    if zone_index is not None:
+        register_zone_index(os.path.join(DATA_DIR, zone_file), zone_index)
 
 
 if __name__ == '__main__':
@@ -273,33 +870,40 @@ if __name__ == '__main__':
     par.add_argument('--dp', action='store_true', default=False, dest='run_dp')
     par.add_argument('--dl', action='store_true', default=False, dest='run_dl')
     par.add_argument('--year', nargs='?', metavar='<YEAR>', type=int, default=-1)
+    par.add_argument('--sp', action='store_true', default=False, dest='single_pass')
+    par.add_argument('--chunk', nargs='?', metavar='<CHUNK ROWS>', type=int, default=0)
+    par.add_argument('--max_pending', nargs='?', metavar='<FILES ON DISK AHEAD>', type=int, default=4)
+    par.add_argument('--force', action='store_true', default=False, dest='force')
+    par.add_argument('--store', nargs='?', metavar='<MATRIX STORE DIR>', type=str, default=None)
+    par.add_argument('--export', action='store_true', default=False, dest='export')
+    par.add_argument('--sparse', action='store_true', default=False, dest='sparse')
+    par.add_argument('--shm', action='store_true', default=False, dest='shared')
+    par.add_argument('--profile', action='store_true', default=False, dest='profile')
+    par.add_argument('--quarantine', action='store_true', default=False, dest='quarantine')
+    par.add_argument('--dist', action='store_true', default=False, dest='distributions')
+    par.add_argument('--no-cache', action='store_false', default=True, dest='cache')
 
     arg = par.parse_args()
 
-    dest = arg.dest
-    RAW_DIR = set_destination(dest)
+    # the same runs as pipeline.py's download and process commands
+    import pipeline
 
-    if arg.run_dp:
-        if arg.run_dl:
-            data_files, zone_file_ = download_file_parallel(arg.dl_threads)
-        else:
-            data_files = get_csv_file_from_dir(RAW_DIR, relative=RAW_DIR)
-            zone_file_ = 'taxi+_zone_lookup.csv'
-        if arg.year != -1:
-            data_files = filter_csv_file_by_time(data_files, year=arg.year)
-        lk_ = mp.Lock()
-        items = []
-        for df in data_files:
-            for hr in range(24):
-                for wd in [True, False]:
-                    items.append((df, zone_file_, wd, hr))
-
-        with mp.Pool(arg.dp_threads,
-                     initializer=init, initargs=(lk_, )) as pool:
-            pool.starmap(data_process_routine, items)
-        # data_process_routine(data_files[0], zone_file_, True, 8)
+    if arg.chunk > 0:
+        routine_ = 'stream'
+    elif arg.shared:
+        routine_ = 'shared'
+    elif arg.single_pass:
+        routine_ = 'month'
     else:
-        if arg.run_dl:
-            download_file_parallel(arg.dl_threads)
+        routine_ = 'slice'
+    config_ = pipeline.Config('process' if arg.run_dp else 'download', dest=arg.dest, threads=arg.dp_threads,
+                              dl_threads=arg.dl_threads, max_pending=arg.max_pending, download=arg.run_dl,
+                              year=None if arg.year == -1 else arg.year, routine=routine_, chunk=arg.chunk,
+                              force=arg.force, store=arg.store, sparse=arg.sparse, quarantine=arg.quarantine,
+                              distributions=arg.distributions, profile=arg.profile, cache=arg.cache)
+    if arg.run_dp or arg.run_dl:
+        pipeline.run(config_)
+    if arg.export and arg.store is not None:
+        pipeline.run(pipeline.Config('export', dest=arg.dest, store=arg.store))
 
     print('done!')
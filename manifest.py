@@ -0,0 +1,39 @@
+import json
+import os
+
+from cache import get_fingerprint
+
+
+class Manifest:
+    # what every output slice was computed from, so that a rerun only redoes missing or stale slices
+    def __init__(self, path):
+        self._path = path
+        try:
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def entry(source, zone, **params):
+        return {'source': get_fingerprint(source),
+                'zone': get_fingerprint(zone),
+                'params': params}
+
+    def is_stale(self, key, entry, outputs):
+        for out in outputs:
+            if not os.path.isfile(out):
+                return True
+        return self._entries.get(key) != entry
+
+    def record(self, key, entry):
+        self._entries[key] = entry
+
+    def save(self):
+        tmp_path = f'{self._path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._path)
@@ -0,0 +1,409 @@
+import numpy as np
+import pandas as pd
+
+from bins import TimeBins
+from profiling import profiled
+
+
+OD_KEY = ['PULocationID', 'DOLocationID']
+
+
+def od_statistics(data: pd.DataFrame):
+    # one grouped pass over the trips: count, distinct pickup days and mean trip time per (PU, DO) pair
+    grouped = data.loc[:, OD_KEY + ['trip_time', 'pickup_day']].groupby(by=OD_KEY)
+    stats = pd.DataFrame({'n_trips': grouped.size(),
+                          'n_days': grouped['pickup_day'].nunique(),
+                          'trip_time': grouped['trip_time'].mean()})
+    return stats
+
+
+def _to_matrix(values: pd.Series, zones, fill_value=np.nan):
+    if len(values.index) < 1:
+        return pd.DataFrame(index=zones, columns=zones, data=fill_value, dtype=float)
+    matrix = values.unstack(level='DOLocationID').reindex(index=zones, columns=zones, fill_value=fill_value)
+    return matrix.rename_axis(index=None, columns=None)
+
+
+def od_matrices(data: pd.DataFrame, zones=None):
+    # AAM (3600 * days / trips) and ATM (mean trip time) over zones x zones, NaN where no trip was observed
+    if zones is None:
+        zones = sorted(data.PULocationID.unique(), key=lambda x: int(x))
+    stats = od_statistics(data)
+    aam = _to_matrix(3600 * stats.n_days / stats.n_trips, zones)
+    atm = _to_matrix(stats.trip_time, zones)
+    return aam, atm
+
+
+def od_counts(data: pd.DataFrame, zones):
+    # distinct days, trips and mean trip time over zones x zones, zero where no trip was observed
+    stats = od_statistics(data)
+    n_days = _to_matrix(stats.n_days, zones, fill_value=0).astype('int64')
+    n_trips = _to_matrix(stats.n_trips, zones, fill_value=0).astype('int64')
+    atm = _to_matrix(stats.trip_time, zones, fill_value=0)
+    return n_days, n_trips, atm
+
+
+class SparseOD:
+    # observed (PU, DO) pairs of one slice in COO form sorted by (PU, DO), so rows are also CSR-addressable
+    # through indptr; zones are the rows/columns of the dense form
+    COL = ['n_trips', 'n_days', 'time_sum']
+
+    def __init__(self, zones, pu, do, n_trips, n_days, time_sum):
+        self.zones = np.array(sorted(int(z) for z in zones), dtype='int64')
+        pu = np.asarray(pu, dtype='int64')
+        do = np.asarray(do, dtype='int64')
+        order = np.lexsort((do, pu))
+        self.pu = pu[order]
+        self.do = do[order]
+        self.n_trips = np.asarray(n_trips, dtype='int64')[order]
+        self.n_days = np.asarray(n_days, dtype='int64')[order]
+        self.time_sum = np.asarray(time_sum, dtype='float64')[order]
+
+    def __len__(self):
+        return len(self.pu)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, c).nbytes for c in ['pu', 'do'] + self.COL)
+
+    @property
+    def indptr(self):
+        return np.append(np.searchsorted(self.pu, self.zones, side='left'), len(self.pu))
+
+    @classmethod
+    def from_data(cls, data: pd.DataFrame, zones=None):
+        if zones is None:
+            zones = data.PULocationID.unique()
+        grouped = data.loc[:, OD_KEY + ['trip_time', 'pickup_day']].groupby(by=OD_KEY)
+        n_trips = grouped.size()
+        pu = n_trips.index.get_level_values('PULocationID')
+        do = n_trips.index.get_level_values('DOLocationID')
+        return cls(zones, pu, do, n_trips.to_numpy(), grouped['pickup_day'].nunique().to_numpy(),
+                   grouped['trip_time'].sum().to_numpy())
+
+    def aam(self):
+        return 3600 * self.n_days / self.n_trips
+
+    def atm(self):
+        return self.time_sum / self.n_trips
+
+    def to_dense(self, values='aam', fill_value=np.nan):
+        values = getattr(self, values)
+        if callable(values):
+            values = values()
+        # pairs leaving the zones (e.g. to a drop-off only zone) have no cell, as in od_matrices()
+        inside = np.isin(self.pu, self.zones) & np.isin(self.do, self.zones)
+        rows = np.searchsorted(self.zones, self.pu[inside])
+        cols = np.searchsorted(self.zones, self.do[inside])
+        dtype = np.result_type(values.dtype, np.min_scalar_type(fill_value))
+        matrix = np.full((len(self.zones), len(self.zones)), fill_value, dtype=dtype)
+        matrix[rows, cols] = values[inside]
+        return pd.DataFrame(matrix, index=self.zones, columns=self.zones)
+
+    def od_matrices(self):
+        return self.to_dense('aam'), self.to_dense('atm')
+
+    def to_frame(self):
+        return pd.DataFrame({'PULocationID': self.pu, 'DOLocationID': self.do,
+                             'n_trips': self.n_trips, 'n_days': self.n_days, 'time_sum': self.time_sum,
+                             'aam': self.aam(), 'atm': self.atm()})
+
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index=False, line_terminator='\n')
+
+    @classmethod
+    def read_csv(cls, path, zones=None):
+        frame = pd.read_csv(path, usecols=OD_KEY + cls.COL)
+        if zones is None:
+            zones = np.union1d(frame.PULocationID, frame.DOLocationID)
+        return cls(zones, frame.PULocationID, frame.DOLocationID, frame.n_trips, frame.n_days, frame.time_sum)
+
+
+def popcount(bits: np.ndarray):
+    return np.unpackbits(bits.astype('<u4').view('uint8')).reshape(bits.shape + (32,)).sum(axis=-1)
+
+
+def pooled_m2(n, total, m2, axis=0):
+    # sum of squared deviations of groups stacked along axis, pooled (Chan et al.): the groups' own M2
+    # plus the spread of their means around the pooled mean
+    n_all = n.sum(axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(n > 0, total / n, 0.)
+        mean_all = np.where(n_all > 0, total.sum(axis=axis) / n_all, 0.)
+    return m2.sum(axis=axis) + (n * (mean - np.expand_dims(mean_all, axis)) ** 2).sum(axis=axis)
+
+
+def hist_quantile(hist, edges, q):
+    # q-quantile of each row of hist, interpolated geometrically inside the bin it falls in
+    n = hist.sum(axis=1)
+    if len(n) < 1:
+        return np.zeros(0)
+    cum = np.cumsum(hist, axis=1)
+    target = q * n
+    idx = np.argmax(cum >= target[:, None], axis=1)
+    rows = np.arange(len(n))
+    below = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.clip((target - below) / hist[rows, idx], 0., 1.)
+    value = edges[idx] * (edges[idx + 1] / edges[idx]) ** frac
+    return np.where(n > 0, value, np.nan)
+
+
+class ODAccumulator:
+    # sufficient statistics per (day group, time bin, PU, DO) cell of bins, by default weekday/weekend by hour.
+    # day_bits holds the pickup days of the month named by period; days of months that have been
+    # merged together are folded into closed_days, so n_days stays the sum of distinct days per month.
+    # With distributions, trip time and distance also get mergeable moments (sum and M2) and histograms
+    # over log-spaced bins spanning what DataProcessor keeps, for mean, variance and quantiles per cell
+    COL = ['PULocationID', 'DOLocationID', 'pickup_weekday', 'pickup_hour', 'pickup_minute', 'pickup_day',
+           'trip_time', 'trip_distance']
+    METRIC = {'time': 'trip_time', 'dist': 'trip_distance'}
+    EDGES = {'time': np.geomspace(60, 7200, 33), 'dist': np.geomspace(.1, 20, 33)}
+    QUANTILES = [.5, .9]
+
+    def __init__(self, zones, period: str = None, bins: TimeBins = None, distributions: bool = False):
+        self.zones = np.array(sorted(int(z) for z in zones), dtype='int64')
+        assert len(self.zones) > 0, 'expect at least 1 zone'
+        self._lookup = np.full(self.zones[-1] + 1, -1, dtype='int64')
+        self._lookup[self.zones] = np.arange(len(self.zones))
+        self.bins = TimeBins() if bins is None else bins
+        shape = self.bins.shape + (len(self.zones), len(self.zones))
+        self.n_trips = np.zeros(shape, dtype='int64')
+        self.time_sum = np.zeros(shape, dtype='float64')
+        # bit d-1 is set when a trip was picked up on day d of the month
+        self.day_bits = np.zeros(shape, dtype='uint32')
+        self.closed_days = np.zeros(shape, dtype='int64')
+        self.period = period
+        self.distributions = distributions
+        if distributions:
+            self.dist_sum = np.zeros(shape, dtype='float64')
+            for m in self.METRIC:
+                setattr(self, f'{m}_m2', np.zeros(shape, dtype='float64'))
+                setattr(self, f'{m}_hist', np.zeros(shape + (len(self.EDGES[m]) - 1, ), dtype='int32'))
+
+    @property
+    def shape(self):
+        return self.n_trips.shape
+
+    def _position(self, location):
+        location = np.asarray(location).astype('int64')
+        pos = np.full(len(location), -1, dtype='int64')
+        known = (location >= 0) & (location < len(self._lookup))
+        pos[known] = self._lookup[location[known]]
+        return pos
+
+    @profiled('od_update')
+    def update(self, data):
+        # data is a cleaned frame, or any mapping of its columns to arrays
+        pu = self._position(data['PULocationID'])
+        do = self._position(data['DOLocationID'])
+        keep = (pu >= 0) & (do >= 0)
+        group, time = self.bins.locate(data, self.period)
+        day = np.asarray(data['pickup_day'])[keep].astype('int64')
+        cell = np.ravel_multi_index((group[keep], time[keep], pu[keep], do[keep]), self.shape)
+
+        size = self.n_trips.size
+        n_trips = np.bincount(cell, minlength=size).reshape(self.shape)
+        if self.distributions:
+            for m, c in self.METRIC.items():
+                self._update_distribution(m, cell, np.asarray(data[c])[keep].astype('float64'))
+        self.n_trips += n_trips
+        self.time_sum += np.bincount(cell, weights=np.asarray(data['trip_time'])[keep],
+                                     minlength=size).reshape(self.shape)
+        cell_day = np.unique(cell * 32 + day - 1)
+        bits = self.day_bits.reshape(-1)
+        np.bitwise_or.at(bits, cell_day // 32, np.left_shift(1, cell_day % 32).astype('uint32'))
+        return self
+
+    def _update_distribution(self, metric, cell, values):
+        # moments of the batch per cell, pooled with those so far, before the batch's counts are added;
+        # only the cells the batch has trips in are touched, so the cost follows its rows, not the cells
+        cells, inverse = np.unique(cell, return_inverse=True)
+        n = np.bincount(inverse)
+        total = np.bincount(inverse, weights=values)
+        m2 = np.bincount(inverse, weights=(values - (total / n)[inverse]) ** 2)
+        m2_attr = f'{metric}_m2'
+        sum_attr = f'{metric}_sum'
+        sums = getattr(self, sum_attr).reshape(-1)
+        m2s = getattr(self, m2_attr).reshape(-1)
+        m2s[cells] = pooled_m2(np.stack([self.n_trips.reshape(-1)[cells], n]), np.stack([sums[cells], total]),
+                               np.stack([m2s[cells], m2]))
+        setattr(self, m2_attr, m2s.reshape(self.shape))
+        if metric != 'time':
+            # time_sum is updated with the counts for every accumulator
+            sums[cells] += total
+            setattr(self, sum_attr, sums.reshape(self.shape))
+        edges = self.EDGES[metric]
+        n_bins = len(edges) - 1
+        hist = getattr(self, f'{metric}_hist').reshape(-1, n_bins)
+        # values outside the edges count in the first or last bin
+        bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, n_bins - 1)
+        hist[cells] += np.bincount(inverse * n_bins + bins, minlength=len(cells) * n_bins).reshape(-1, n_bins)
+        setattr(self, f'{metric}_hist', hist.reshape(self.shape + (n_bins,)))
+
+    @property
+    def n_days(self):
+        return self.closed_days + popcount(self.day_bits)
+
+    def is_empty(self):
+        return not self.n_trips.any()
+
+    def merge(self, other: 'ODAccumulator'):
+        assert np.array_equal(self.zones, other.zones), 'cannot merge accumulators over different zones'
+        assert self.bins == other.bins, f'cannot merge {other.bins} into {self.bins}'
+        assert self.distributions == other.distributions, 'cannot merge accumulators with and without distributions'
+        if other.is_empty():
+            return self
+        if self.distributions:
+            for m in self.METRIC:
+                setattr(self, f'{m}_m2', pooled_m2(np.stack([self.n_trips, other.n_trips]),
+                                                   np.stack([getattr(self, f'{m}_sum'), getattr(other, f'{m}_sum')]),
+                                                   np.stack([getattr(self, f'{m}_m2'), getattr(other, f'{m}_m2')])))
+                getattr(self, f'{m}_hist')[...] += getattr(other, f'{m}_hist')
+            self.dist_sum += other.dist_sum
+        if self.is_empty() and not self.closed_days.any():
+            self.period = other.period
+        if self.period is not None and self.period == other.period:
+            self.day_bits |= other.day_bits
+            self.closed_days += other.closed_days
+        else:
+            self.closed_days = self.n_days + other.n_days
+            self.day_bits[...] = 0
+            self.period = None
+        self.n_trips += other.n_trips
+        self.time_sum += other.time_sum
+        return self
+
+    def coarsen(self, bins: TimeBins):
+        # the same trips in coarser bins, by summing the bins here; n_days only stays exact for a single
+        # month, so months are coarsened before they are merged
+        assert not self.closed_days.any(), 'coarsen each month before merging months'
+        group_map = self.bins.coarsen_map(bins)
+        step = bins.minutes // self.bins.minutes
+        coarse = ODAccumulator(self.zones, period=self.period, bins=bins, distributions=self.distributions)
+        shape = (len(self.bins.day_labels), bins.n_times, step) + self.shape[2:]
+        n_trips = self.n_trips.reshape(shape)
+        sums = {k: getattr(self, k).reshape(shape + getattr(self, k).shape[4:]) for k in self._sums()}
+        moments = {m: pooled_m2(n_trips, sums[f'{m}_sum'], getattr(self, f'{m}_m2').reshape(shape), axis=2)
+                   for m in self.METRIC} if self.distributions else dict()
+        n_trips = n_trips.sum(axis=2)
+        sums = {k: v.sum(axis=2) for k, v in sums.items()}
+        day_bits = np.bitwise_or.reduce(self.day_bits.reshape(shape), axis=2)
+        for cg in range(len(bins.day_labels)):
+            gs = np.flatnonzero(group_map == cg)
+            coarse.n_trips[cg] = n_trips[gs].sum(axis=0)
+            coarse.day_bits[cg] = np.bitwise_or.reduce(day_bits[gs], axis=0)
+            for k, v in sums.items():
+                getattr(coarse, k)[cg] = v[gs].sum(axis=0)
+            for m, m2 in moments.items():
+                getattr(coarse, f'{m}_m2')[cg] = pooled_m2(n_trips[gs], sums[f'{m}_sum'][gs], m2[gs], axis=0)
+        return coarse
+
+    def _sums(self):
+        # cell arrays that coarsen and merge by summing
+        keys = ['time_sum']
+        if self.distributions:
+            keys += ['dist_sum'] + [f'{m}_hist' for m in self.METRIC]
+        return keys
+
+    def _arrays(self):
+        keys = ['n_trips', 'time_sum', 'day_bits', 'closed_days']
+        if self.distributions:
+            keys += ['dist_sum'] + [f'{m}_{k}' for m in self.METRIC for k in ['m2', 'hist']]
+        return keys
+
+    def save(self, file):
+        np.savez_compressed(file, zones=self.zones, period=np.array('' if self.period is None else self.period),
+                            bins=np.array(self.bins.to_json()), **{k: getattr(self, k) for k in self._arrays()})
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as npz:
+            # partials saved before bins were configurable are weekday/weekend by hour
+            bins = TimeBins.from_json(str(npz['bins'])) if 'bins' in npz.files else None
+            acc = cls(npz['zones'], period=str(npz['period']) or None, bins=bins,
+                      distributions='dist_sum' in npz.files)
+            for key in acc._arrays():
+                setattr(acc, key, npz[key])
+        return acc
+
+    @classmethod
+    def reduce(cls, accumulators):
+        result = None
+        for acc in accumulators:
+            if result is None:
+                result = cls(acc.zones, period=acc.period, bins=acc.bins, distributions=acc.distributions)
+            result.merge(acc)
+        return result
+
+    @staticmethod
+    def _aam(n_days, n_trips):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(n_trips > 0, 3600 * n_days / n_trips, np.nan)
+
+    @staticmethod
+    def _atm(time_sum, n_trips):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(n_trips > 0, time_sum / n_trips, np.nan)
+
+    def aam(self):
+        return self._aam(self.n_days, self.n_trips)
+
+    def atm(self):
+        return self._atm(self.time_sum, self.n_trips)
+
+    def slices(self):
+        # (day, time) positions with their labels, in file name order
+        return [(d, t, day, time) for d, day in enumerate(self.bins.day_labels)
+                for t, time in enumerate(self.bins.time_labels)]
+
+    def _observed(self, d, time, low_bd=None):
+        # without low_bd, every pair with trips over all zones, as od_counts; with it, the pairs between the
+        # pickup zones filter_demand(low_bd) keeps
+        n_trips = self.n_trips[d, time]
+        keep = np.ones(len(self.zones), dtype=bool)
+        observed = n_trips > 0
+        if low_bd is not None:
+            keep = n_trips.sum(axis=1) > low_bd
+            observed &= keep[:, None] & keep[None, :]
+        pu, do = np.nonzero(observed)
+        return keep, pu, do
+
+    @profiled('od_slice')
+    def to_sparse(self, day, time: int, low_bd: int = None):
+        # observed pairs of the slice, after filter_demand(low_bd) when low_bd is given; day is
+        # True/False for weekday/weekend, a day label or its position, time the time bin
+        d = self.bins.day_index(day)
+        n_trips = self.n_trips[d, time]
+        keep, pu, do = self._observed(d, time, low_bd)
+        n_days = self.closed_days[d, time, pu, do] + popcount(self.day_bits[d, time, pu, do])
+        return SparseOD(self.zones[keep], self.zones[pu], self.zones[do], n_trips[pu, do], n_days,
+                        self.time_sum[d, time, pu, do])
+
+    def to_distributions(self, day, time: int, low_bd: int = None):
+        # mean, sample variance and quantiles of trip time and distance per observed pair of the slice
+        assert self.distributions, 'accumulated without distributions'
+        d = self.bins.day_index(day)
+        _, pu, do = self._observed(d, time, low_bd)
+        n = self.n_trips[d, time, pu, do]
+        frame = {'PULocationID': self.zones[pu], 'DOLocationID': self.zones[do], 'n_trips': n}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for m in self.METRIC:
+                frame[f'{m}_mean'] = getattr(self, f'{m}_sum')[d, time, pu, do] / n
+                frame[f'{m}_var'] = np.where(n > 1, getattr(self, f'{m}_m2')[d, time, pu, do] / (n - 1), np.nan)
+                hist = getattr(self, f'{m}_hist')[d, time, pu, do]
+                for q in self.QUANTILES:
+                    frame[f'{m}_p{int(round(q * 100))}'] = hist_quantile(hist, self.EDGES[m], q)
+        return pd.DataFrame(frame)
+
+    def od_matrices(self, day, time: int, low_bd: int = None):
+        # same matrices as od_matrices() on the slice, after filter_demand(low_bd) when low_bd is given
+        return self.to_sparse(day, time, low_bd=low_bd).od_matrices()
+
+    def od_counts(self, day, time: int):
+        # distinct days, trips and mean trip time over all zones, zero where no trip was observed
+        d = self.bins.day_index(day)
+        n_trips = self.n_trips[d, time]
+        n_days = self.closed_days[d, time] + popcount(self.day_bits[d, time])
+        atm = np.nan_to_num(self._atm(self.time_sum[d, time], n_trips))
+        return [pd.DataFrame(m, index=self.zones, columns=self.zones) for m in (n_days, n_trips, atm)]
@@ -0,0 +1,335 @@
+import argparse as ap
+import functools
+import json
+import multiprocessing as mp
+import os
+import time
+
+import agg_2019
+import main
+import profiling
+from logger import Listener, log
+from manifest import Manifest
+from profiling import stage
+from scheduler import Progress, file_cost, run_tasks
+from store import MatrixStore
+from zones import load_zone_index
+from util import RAW_DIR, DATA_DIR, AAM_DIR, ATM_DIR, LOG_DIR, download_file_parallel, download_file_pipeline, \
+    filter_csv_file_by_range, filter_csv_file_by_time, get_csv_file_from_dir
+
+ZONE_FILE = 'taxi+_zone_lookup.csv'
+ROUTINES = {'slice': main.data_process_routine,
+            'month': main.month_process_routine,
+            'stream': main.stream_process_routine,
+            'shared': main.shared_process_routine}
+
+
+class Config:
+    # everything one run depends on; command is one of COMMANDS, the other options keep their CLI defaults
+    COMMANDS = ['download', 'process', 'aggregate', 'export']
+
+    def __init__(self, command: str, **kwargs):
+        assert command in self.COMMANDS, f'Unknown command: {command}, must be in {self.COMMANDS}'
+        self.command = command
+        self.dest = kwargs.pop('dest', None)
+        self.threads = kwargs.pop('threads', 4)
+        self.dl_threads = kwargs.pop('dl_threads', 2)
+        self.max_pending = kwargs.pop('max_pending', 4)
+        # process each file as soon as it is downloaded
+        self.download = kwargs.pop('download', False)
+        self.year = kwargs.pop('year', None)
+        self.start = kwargs.pop('start', None)
+        self.end = kwargs.pop('end', None)
+        self.routine = kwargs.pop('routine', 'month' if command == 'aggregate' else 'slice')
+        self.chunk = kwargs.pop('chunk', 0)
+        self.location = kwargs.pop('location', 'Manhattan')
+        self.low_bd = kwargs.pop('low_bd', main.LOW_BD)
+        self.zone_file = kwargs.pop('zone_file', ZONE_FILE)
+        self.force = kwargs.pop('force', False)
+        self.store = kwargs.pop('store', None)
+        self.sparse = kwargs.pop('sparse', False)
+        self.quarantine = kwargs.pop('quarantine', False)
+        self.distributions = kwargs.pop('distributions', False)
+        self.profile = kwargs.pop('profile', False)
+        self.cache = kwargs.pop('cache', True)
+        # aggregate only
+        self.bins = kwargs.pop('bins', '60:daytype')
+        self.coarsen = kwargs.pop('coarsen', None)
+        self.holidays = kwargs.pop('holidays', None)
+        self.rollup = kwargs.pop('rollup', False)
+        self.name = kwargs.pop('name', None)
+        # export only
+        self.months = kwargs.pop('months', None)
+        assert len(kwargs) == 0, f'Unknown options: {list(kwargs.keys())}'
+
+        if command == 'aggregate':
+            assert self.routine in ('month', 'shared'), f'invalid routine={self.routine} for aggregate'
+        else:
+            assert self.routine in ROUTINES, f'Unknown routine: {self.routine}, must be in {list(ROUTINES.keys())}'
+        assert not self.distributions or command != 'process' or self.routine in ('stream', 'shared'), \
+            'distributions are computed by the accumulating routines, stream or shared'
+        self.profile_dir = os.path.join(LOG_DIR, f'profile-{int(time.time())}') if self.profile else None
+
+    @property
+    def raw_dir(self):
+        return RAW_DIR if self.dest is None else os.path.join(os.path.realpath(self.dest), 'data/raw')
+
+    def settings(self):
+        # what the routines read, in the parent and in the worker of every task
+        return main.RunSettings(raw_dir=self.raw_dir, store_path=self.store if self.command == 'process' else None,
+                                sparse=self.sparse and self.store is None, quarantine=self.quarantine,
+                                distributions=self.distributions, profile_dir=self.profile_dir, cache=self.cache)
+
+    def select(self, files):
+        if self.year is not None:
+            files = filter_csv_file_by_time(files, year=self.year) or []
+        return filter_csv_file_by_range(files, start=self.start, end=self.end)
+
+
+def _run_configured(settings: main.RunSettings, func, *args):
+    # profiling records whatever runs in the worker; everything else is read from settings by func
+    profiling.enable(settings.profile_dir)
+    return func(*args, settings=settings)
+
+
+def configured(settings: main.RunSettings, func):
+    # func as a picklable task given the run's settings in whichever worker runs it
+    return functools.partial(_run_configured, settings, func)
+
+
+class WorkerPool:
+    # processes kept across runs, so their zone indexes and loaded modules stay warm; every task carries
+    # the settings of its run, so one pool serves runs with different options. The workers and this
+    # process log to the pool's listener
+    def __init__(self, processes: int = 4, zone_file: str = ZONE_FILE):
+        self.processes = processes
+        self.listener = Listener()
+        zone_index = None
+        if zone_file is not None and os.path.isfile(os.path.join(DATA_DIR, zone_file)):
+            zone_index = load_zone_index(os.path.join(DATA_DIR, zone_file))
+        self.pool = mp.Pool(processes, initializer=main.init,
+                            initargs=(self.listener.queue, zone_file, zone_index))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def download(config: Config, pool: WorkerPool = None):
+    files, zone_file = download_file_parallel(config.dl_threads, config.dest)
+    return {'files': files, 'zone_file': zone_file}
+
+
+def process(config: Config, pool: WorkerPool):
+    # AAM/ATM slices of every raw file with stale slices, as main.py --dp
+    settings = config.settings()
+    manifest = Manifest(main.MANIFEST)
+    started = int(time.time())
+    stale_slices = dict()
+
+    def get_items(df, zone_file):
+        if len(config.select([df])) < 1:
+            return []
+        if config.force:
+            stale = [(wd, hr) for wd in [True, False] for hr in range(24)]
+        else:
+            stale = main.get_stale_slices(manifest, df, zone_file, settings, location=config.location,
+                                          low_bd=config.low_bd)
+        if len(stale) < 1:
+            log('info', f'{main.get_file_name(df)}...up to date')
+            return []
+        stale_slices[(df, zone_file)] = stale
+        if settings.store is not None:
+            for wd, hr in stale:
+                settings.store.clear(main.get_file_name(df), wd, hr)
+            settings.store.flush()
+        if config.routine == 'stream':
+            return [(df, zone_file, config.location, config.chunk if config.chunk > 0 else 1000000, config.low_bd)]
+        if config.routine == 'month':
+            return [(df, zone_file, config.location, config.low_bd)]
+        if config.routine == 'shared':
+            return [(df, zone_file)]
+        return [(df, zone_file, wd, hr, config.location, config.low_bd) for wd, hr in stale]
+
+    if config.download:
+        downloads, zone_file_ = download_file_pipeline(config.dl_threads, config.max_pending, config.dest)
+        data_files = downloads.names
+    else:
+        downloads, zone_file_ = None, config.zone_file
+        data_files = get_csv_file_from_dir(config.raw_dir, relative=config.raw_dir)
+    if config.store is not None:
+        MatrixStore.open_or_create(config.store, [main.get_file_name(df) for df in data_files],
+                                   main.get_location_zones(zone_file_, config.location)).flush()
+
+    routine = configured(settings, ROUTINES[config.routine])
+    if config.routine == 'shared':
+        # the parent reads each month and writes its slices; workers only aggregate
+        progress = Progress()
+        options = {'location': config.location, 'low_bd': config.low_bd}
+        if downloads is not None:
+            for df in downloads:
+                main.process_shared(pool.pool, get_items(df, zone_file_), pool.processes, progress, settings,
+                                    **options)
+                downloads.release()
+        else:
+            main.process_shared(pool.pool, [it for df in data_files for it in get_items(df, zone_file_)],
+                                pool.processes, progress, settings, **options)
+    elif downloads is not None:
+        main.process_as_downloaded(downloads, pool.pool, routine, lambda df: get_items(df, zone_file_),
+                                   config.raw_dir)
+    else:
+        items = [it for df in data_files for it in get_items(df, zone_file_)]
+        run_tasks(pool.pool, routine, items, lambda it: main.get_task_cost(it, config.raw_dir),
+                  report=main.report_progress)
+
+    written, failed = [], []
+    for (df, zf), stale in stale_slices.items():
+        recorded = main.record_slices(manifest, df, zf, started, settings, location=config.location,
+                                      low_bd=config.low_bd)
+        written += recorded
+        name = main.get_file_name(df)
+        failed += [k for k in (f'{name}-{"wd" if wd else "wn"}-{hr}' for wd, hr in stale) if k not in recorded]
+    manifest.save()
+    return {'files': [df for df, _ in stale_slices], 'written': written, 'failed': failed}
+
+
+def aggregate(config: Config, pool: WorkerPool):
+    # monthly partial accumulators, combined over [start, end], as agg_2019.py
+    settings = config.settings()
+    start = config.start if config.start is not None or config.year is None else f'{config.year}-01'
+    end = config.end if config.end is not None or config.year is None else f'{config.year}-12'
+    name = config.name
+    if name is None and config.start is None and config.end is None and config.year is not None:
+        name = str(config.year)
+    elif name is None and start is not None and end is not None:
+        name = f'{start}_{end}'
+    bins = agg_2019.parse_bins(config.bins, config.holidays)
+    coarse_bins = [] if config.coarsen is None else [agg_2019.parse_bins(b, config.holidays)
+                                                     for b in config.coarsen.split(',')]
+
+    partials, failed = [], []
+    if not config.rollup:
+        files = filter_csv_file_by_range(get_csv_file_from_dir(config.raw_dir), start=start, end=end)
+        zones = list(load_zone_index(os.path.join(DATA_DIR, config.zone_file)).zones(config.location))
+        if config.routine == 'shared':
+            progress = Progress()
+            files = sorted(files, key=lambda f: file_cost(os.path.join(config.raw_dir, f)), reverse=True)
+            progress.add(sum(file_cost(os.path.join(config.raw_dir, f)) for f in files), len(files))
+            results = []
+            for f in files:
+                results.append(agg_2019.aggregate_month_shared(f, config.zone_file, zones, pool.pool, pool.processes,
+                                                               config.location, bins, config.distributions,
+                                                               settings))
+                progress.done(file_cost(os.path.join(config.raw_dir, f)))
+                main.report_progress(progress)
+        else:
+            items = [(f, config.zone_file, zones, config.location, config.chunk, bins, config.distributions)
+                     for f in files]
+            results = run_tasks(pool.pool, configured(settings, agg_2019.aggregate_month_data), items,
+                                lambda it: file_cost(os.path.join(config.raw_dir, it[0])))
+        partials = [p for p in results if p is not None]
+        failed = [f for f, p in zip(files, results) if p is None]
+    else:
+        partials = agg_2019.get_partial_files(start, end, location=config.location, bins=bins,
+                                              distributions=config.distributions)
+
+    if name is None and len(partials) > 0:
+        # without a complete range, the outputs are named by the months found
+        months = sorted(agg_2019.get_month_name(p) for p in partials)
+        name = months[0] if months[0] == months[-1] else f'{months[0]}_{months[-1]}'
+
+    # only the partials of this run, so a month that failed is not filled in by an older partial
+    outputs = agg_2019.combine_results(partials, name, sparse=config.sparse)
+    for b in coarse_bins:
+        outputs += agg_2019.combine_results(partials, name, sparse=config.sparse, bins=b)
+    return {'partials': partials, 'failed': failed, 'outputs': outputs}
+
+
+def export(config: Config, pool: WorkerPool = None):
+    assert config.store is not None, 'export needs a matrix store'
+    with stage('export'):
+        files = MatrixStore(config.store).export_csv(AAM_DIR, ATM_DIR, months=config.months)
+    return {'outputs': files}
+
+
+COMMANDS = {'download': download, 'process': process, 'aggregate': aggregate, 'export': export}
+
+
+def run(config: Config, pool: WorkerPool = None):
+    # one command, returning what it did as a dict; pass a WorkerPool to reuse its workers across runs,
+    # else one is started and closed for this run when the command needs it
+    started = time.time()
+    profiling.enable(config.profile_dir)
+    own_pool = pool is None and config.command in ('process', 'aggregate')
+    if own_pool:
+        pool = WorkerPool(config.threads, config.zone_file)
+    try:
+        result = COMMANDS[config.command](config, pool)
+    finally:
+        if own_pool:
+            pool.close()
+    result = dict(command=config.command, elapsed=time.time() - started, **result)
+    if config.profile:
+        profiling.report(f'{config.profile_dir}.json')
+        result['profile'] = f'{config.profile_dir}.json'
+        print(f'profile...{config.profile_dir}.json')
+    return result
+
+
+if __name__ == '__main__':
+
+    par = ap.ArgumentParser(prog='pipeline', description='download, process, aggregate and export TLC trip data')
+    sub = par.add_subparsers(dest='command', required=True)
+    common = ap.ArgumentParser(add_help=False)
+    common.add_argument('--dest', nargs='?', metavar='<RAW DATA DIR>', type=str, default=None)
+    common.add_argument('--profile', action='store_true', default=False, dest='profile')
+    common.add_argument('--out', nargs='?', metavar='<RESULT JSON>', type=str, default=None)
+    work = ap.ArgumentParser(add_help=False)
+    work.add_argument('--threads', nargs='?', metavar='<PROCESS THREADS>', type=int, default=4)
+    work.add_argument('--chunk', nargs='?', metavar='<CHUNK ROWS>', type=int, default=0)
+    work.add_argument('--year', nargs='?', metavar='<YEAR>', type=int, default=None)
+    work.add_argument('--start', nargs='?', metavar='<YYYY-MM>', type=str, default=None)
+    work.add_argument('--end', nargs='?', metavar='<YYYY-MM>', type=str, default=None)
+    work.add_argument('--location', nargs='?', metavar='<BOROUGH>', type=str, default='Manhattan')
+    work.add_argument('--sparse', action='store_true', default=False, dest='sparse')
+    work.add_argument('--quarantine', action='store_true', default=False, dest='quarantine')
+    work.add_argument('--dist', action='store_true', default=False, dest='distributions')
+    work.add_argument('--no-cache', action='store_false', default=True, dest='cache')
+
+    dl = sub.add_parser('download', parents=[common])
+    dl.add_argument('--dl_threads', nargs='?', metavar='<DOWNLOAD THREADS>', type=int, default=2)
+    pr = sub.add_parser('process', parents=[common, work])
+    pr.add_argument('--routine', nargs='?', metavar='<ROUTINE>', type=str, default='slice', choices=list(ROUTINES))
+    pr.add_argument('--dl', action='store_true', default=False, dest='download')
+    pr.add_argument('--dl_threads', nargs='?', metavar='<DOWNLOAD THREADS>', type=int, default=2)
+    pr.add_argument('--max_pending', nargs='?', metavar='<FILES ON DISK AHEAD>', type=int, default=4)
+    pr.add_argument('--force', action='store_true', default=False, dest='force')
+    pr.add_argument('--store', nargs='?', metavar='<MATRIX STORE DIR>', type=str, default=None)
+    ag = sub.add_parser('aggregate', parents=[common, work])
+    ag.add_argument('--routine', nargs='?', metavar='<ROUTINE>', type=str, default='month',
+                    choices=['month', 'shared'])
+    ag.add_argument('--rollup', action='store_true', default=False, dest='rollup')
+    ag.add_argument('--name', nargs='?', metavar='<OUTPUT NAME>', type=str, default=None)
+    ag.add_argument('--bins', nargs='?', metavar='<MINUTES:DAYS>', type=str, default='60:daytype')
+    ag.add_argument('--coarsen', nargs='?', metavar='<MINUTES:DAYS,...>', type=str, default=None)
+    ag.add_argument('--holidays', nargs='?', metavar='<HOLIDAY FILE OR DATES>', type=str, default=None)
+    ex = sub.add_parser('export', parents=[common])
+    ex.add_argument('--store', nargs='?', metavar='<MATRIX STORE DIR>', type=str, required=True)
+    ex.add_argument('--months', nargs='?', metavar='<YYYY-MM,...>', type=str, default=None)
+
+    arg = vars(par.parse_args())
+    out_ = arg.pop('out')
+    if arg.get('months') is not None:
+        arg['months'] = arg['months'].split(',')
+    result_ = run(Config(**arg))
+    if out_ is not None:
+        with open(out_, 'w') as f:
+            json.dump(result_, f, indent=1)
+    print(json.dumps({k: len(v) if isinstance(v, list) else v for k, v in result_.items()}))
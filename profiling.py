@@ -0,0 +1,122 @@
+import functools
+import glob
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_dir = None
+
+
+def enable(directory):
+    # every process appends its stage records to its own file under directory; report() merges them
+    global _dir
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory)
+    _dir = directory
+
+
+def enabled():
+    return _dir is not None
+
+
+def peak_rss():
+    # high-water mark of this process' resident set, in bytes
+    if resource is None:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count_rows(obj):
+    if isinstance(obj, pd.DataFrame):
+        return len(obj.index)
+    if isinstance(obj, dict) and len(obj) > 0:
+        return len(next(iter(obj.values())))
+    data = getattr(obj, '_data', None)
+    if isinstance(data, pd.DataFrame):
+        return len(data.index)
+
+
+def _write(record):
+    with open(os.path.join(_dir, f'profile-{os.getpid()}.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    # with stage('name', rows_in=n) as rec: ... rec['rows_out'] = m
+    record = {'stage': name, 'pid': os.getpid(), 'rows_in': rows_in, 'rows_out': None}
+    if _dir is None:
+        yield record
+        return
+    start = time.perf_counter()
+    start_peak = peak_rss()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - start
+        # the process' high-water mark is kept for its lifetime, so a stage is rated by how much it raised it
+        record['process_peak_rss'] = peak_rss()
+        record['peak_rss_growth'] = None if start_peak is None else record['process_peak_rss'] - start_peak
+        _write(record)
+
+
+def profiled(name=None):
+    # records func as a stage; rows_in counts the first argument holding rows, rows_out the returned
+    # object, or the first argument again when nothing is returned
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _dir is None:
+                return func(*args, **kwargs)
+            rows_in = next((n for n in map(count_rows, args) if n is not None), None)
+            with stage(stage_name, rows_in=rows_in) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = count_rows(result if result is not None or not args else args[0])
+            return result
+        return wrapper
+    return decorator
+
+
+def _summarize(records):
+    wall = sum(r['wall'] for r in records)
+    rows_in = sum(r['rows_in'] for r in records if r['rows_in'] is not None)
+    rows_out = sum(r['rows_out'] for r in records if r['rows_out'] is not None)
+    rss = [r['process_peak_rss'] for r in records if r.get('process_peak_rss') is not None]
+    growth = [r['peak_rss_growth'] for r in records if r.get('peak_rss_growth') is not None]
+    # stages that only produce rows (reads) are rated by their output
+    rows = rows_in if rows_in > 0 else rows_out
+    return {'calls': len(records), 'wall': wall, 'rows_in': rows_in, 'rows_out': rows_out,
+            'rows_per_s': rows / wall if wall > 0 else None,
+            'process_peak_rss': max(rss) if len(rss) > 0 else None,
+            'peak_rss_growth': max(growth) if len(growth) > 0 else None}
+
+
+def report(path=None):
+    # per stage over all processes, and per stage of every process, written to path as JSON
+    assert _dir is not None, 'profiling is not enabled'
+    records = []
+    for file in sorted(glob.glob(os.path.join(_dir, 'profile-*.jsonl'))):
+        with open(file, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    stages, workers = dict(), dict()
+    for r in records:
+        stages.setdefault(r['stage'], []).append(r)
+        workers.setdefault(str(r['pid']), dict()).setdefault(r['stage'], []).append(r)
+    result = {'stages': {s: _summarize(rs) for s, rs in stages.items()},
+              'workers': {pid: {s: _summarize(rs) for s, rs in ws.items()} for pid, ws in workers.items()}}
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+    return result
@@ -0,0 +1,64 @@
+import os
+import time
+
+
+class Progress:
+    # finished work in units of estimated cost; the ETA assumes what is left runs at the rate seen so far
+    def __init__(self):
+        self.total = 0.
+        self.finished = 0.
+        self.n_tasks = 0
+        self.n_done = 0
+        self._start = time.time()
+
+    def add(self, cost, n_tasks=1):
+        self.total += cost
+        self.n_tasks += n_tasks
+
+    def done(self, cost):
+        self.finished += cost
+        self.n_done += 1
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start
+
+    @property
+    def eta(self):
+        if self.finished <= 0:
+            return
+        return self.elapsed * (self.total - self.finished) / self.finished
+
+    def __str__(self):
+        share = 100. * self.finished / self.total if self.total > 0 else 100. * self.n_done / max(self.n_tasks, 1)
+        eta = self.eta
+        eta = '?' if eta is None else f'{eta:.0f}s'
+        return f'[{self.n_done}/{self.n_tasks} tasks, {share:.1f}%, elapsed {self.elapsed:.0f}s, eta {eta}]'
+
+
+def file_cost(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _call(args):
+    func, index, item = args
+    return index, func(*item)
+
+
+def run_tasks(pool, func, items, cost, report=print):
+    # largest estimated tasks first, handed out one at a time to whichever worker is free,
+    # so a big file never starts last behind a tail of small ones
+    costs = [cost(it) for it in items]
+    order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+    progress = Progress()
+    progress.add(sum(costs), len(items))
+    results = [None] * len(items)
+    for index, result in pool.imap_unordered(_call, [(func, i, items[i]) for i in order], chunksize=1):
+        results[index] = result
+        progress.done(costs[index])
+        if report is not None:
+            report(progress)
+    return results
@@ -0,0 +1,81 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+class SharedColumns:
+    # columns of a frame copied once into shared memory blocks; spec is small and picklable, and
+    # attach_columns(spec) maps the same blocks as NumPy arrays in any process without copying them
+    def __init__(self, data: pd.DataFrame, columns=None):
+        if columns is None:
+            columns = list(data.columns)
+        self._blocks = []
+        self.spec = {'rows': len(data.index), 'columns': []}
+        try:
+            for c in columns:
+                arr = np.ascontiguousarray(data[c].to_numpy())
+                block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                self._blocks.append(block)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[...] = arr
+                self.spec['columns'].append((c, arr.dtype.str, block.name))
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.spec['rows']
+
+    @property
+    def nbytes(self):
+        return sum(block.size for block in self._blocks)
+
+    def partitions(self, n):
+        # n contiguous row ranges of about the same size
+        bounds = np.linspace(0, len(self), max(n, 1) + 1).astype('int64')
+        return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _attach_block(name):
+    # only the creator unlinks a block; before Python 3.13 attaching also registered it with the
+    # worker's resource tracker, which would unlink it (and warn) when the worker exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+class attach_columns:
+    # with attach_columns(spec) as columns: columns[name] is a read-only view of the shared block
+    def __init__(self, spec):
+        self._spec = spec
+        self._blocks = []
+
+    def __enter__(self):
+        columns = dict()
+        for c, dtype, name in self._spec['columns']:
+            block = _attach_block(name)
+            self._blocks.append(block)
+            arr = np.ndarray((self._spec['rows'], ), dtype=np.dtype(dtype), buffer=block.buf)
+            arr.flags.writeable = False
+            columns[c] = arr
+        return columns
+
+    def __exit__(self, *args):
+        for block in self._blocks:
+            block.close()
+        self._blocks = []
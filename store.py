@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+META = 'meta.json'
+DAYTYPE = ['wd', 'wn']
+HOURS = 24
+
+
+class MatrixStore:
+    # AAM/ATM of every slice in two (month, daytype, hour, PU, DO) float64 .npy files, opened memory-mapped.
+    # kept marks, per slice, the zones that survived the demand filter (the rows/columns of the legacy CSV),
+    # written marks the slices that hold results
+    ARRAYS = ['aam', 'atm', 'kept', 'written']
+
+    def __init__(self, path, mode='r'):
+        assert mode in ('r', 'r+'), f'invalid mode: {mode}, need \'r\' or \'r+\''
+        with open(os.path.join(path, META), 'r') as f:
+            meta = json.load(f)
+        self.path = path
+        self.months = meta['months']
+        self.zones = np.array(meta['zones'], dtype='int64')
+        self._month_pos = {m: i for i, m in enumerate(self.months)}
+        self._zone_pos = {z: i for i, z in enumerate(self.zones)}
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mode))
+
+    @classmethod
+    def create(cls, path, months, zones):
+        months = sorted(set(months))
+        zones = sorted(int(z) for z in zones)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        shape = (len(months), len(DAYTYPE), HOURS)
+        matrix_shape = shape + (len(zones), len(zones))
+        for name, dtype, sh, fill in [('aam', 'float64', matrix_shape, np.nan),
+                                      ('atm', 'float64', matrix_shape, np.nan),
+                                      ('kept', 'bool', shape + (len(zones), ), False),
+                                      ('written', 'bool', shape, False)]:
+            arr = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=sh)
+            arr[...] = fill
+            arr.flush()
+            del arr
+        with open(os.path.join(path, META), 'w') as f:
+            json.dump({'months': months, 'zones': zones, 'daytype': DAYTYPE, 'hours': HOURS}, f)
+        return cls(path, mode='r+')
+
+    @classmethod
+    def open_or_create(cls, path, months, zones):
+        # an existing store is reused when it covers the zones and months, otherwise it is grown
+        if not os.path.isfile(os.path.join(path, META)):
+            return cls.create(path, months, zones)
+        old = cls(path, mode='r')
+        zones = sorted(set(int(z) for z in zones) | set(old.zones.tolist()))
+        months = sorted(set(months) | set(old.months))
+        if months == old.months and zones == old.zones.tolist():
+            del old
+            return cls(path, mode='r+')
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        new = cls.create(tmp_path, months, zones)
+        m_idx = [new._month_pos[m] for m in old.months]
+        z_idx = [new._zone_pos[z] for z in old.zones]
+        for i, m in enumerate(m_idx):
+            new.aam[m][np.ix_(range(len(DAYTYPE)), range(HOURS), z_idx, z_idx)] = old.aam[i]
+            new.atm[m][np.ix_(range(len(DAYTYPE)), range(HOURS), z_idx, z_idx)] = old.atm[i]
+            new.kept[m][:, :, z_idx] = old.kept[i]
+            new.written[m] = old.written[i]
+        new.flush()
+        del old, new
+        for name in cls.ARRAYS + [META]:
+            file = f'{name}.npy' if name != META else META
+            os.replace(os.path.join(tmp_path, file), os.path.join(path, file))
+        os.rmdir(tmp_path)
+        return cls(path, mode='r+')
+
+    def flush(self):
+        for name in self.ARRAYS:
+            arr = getattr(self, name)
+            if isinstance(arr, np.memmap):
+                arr.flush()
+
+    def _index(self, month, weekday, hour):
+        return self._month_pos[month], 0 if weekday else 1, hour
+
+    def write(self, month, weekday: bool, hour: int, aam: pd.DataFrame, atm: pd.DataFrame):
+        m, d, h = self._index(month, weekday, hour)
+        pos = [self._zone_pos[int(z)] for z in aam.index]
+        cells = np.ix_(pos, pos)
+        self.aam[m, d, h] = np.nan
+        self.atm[m, d, h] = np.nan
+        self.aam[m, d, h][cells] = aam.to_numpy(dtype='float64')
+        self.atm[m, d, h][cells] = atm.loc[aam.index, aam.columns].to_numpy(dtype='float64')
+        self.kept[m, d, h] = False
+        self.kept[m, d, h, pos] = True
+        self.written[m, d, h] = True
+
+    def clear(self, month, weekday: bool, hour: int):
+        self.written[self._index(month, weekday, hour)] = False
+
+    def is_written(self, month, weekday: bool, hour: int):
+        if month not in self._month_pos:
+            return False
+        return bool(self.written[self._index(month, weekday, hour)])
+
+    def get(self, month=None, weekday: bool = None, hour: int = None, which='aam'):
+        # basic indexing only, so the result is a view into the memory map
+        key = (slice(None) if month is None else self._month_pos[month],
+               slice(None) if weekday is None else (0 if weekday else 1),
+               slice(None) if hour is None else hour)
+        return getattr(self, which)[key]
+
+    def to_frames(self, month, weekday: bool, hour: int):
+        # the AAM/ATM frames of one slice, restricted to its kept zones like the legacy CSV
+        m, d, h = self._index(month, weekday, hour)
+        kept = np.asarray(self.kept[m, d, h])
+        zones = self.zones[kept]
+        cells = np.ix_(kept, kept)
+        aam = pd.DataFrame(np.asarray(self.aam[m, d, h])[cells], index=zones, columns=zones)
+        atm = pd.DataFrame(np.asarray(self.atm[m, d, h])[cells], index=zones, columns=zones)
+        return aam, atm
+
+    def export_csv(self, aam_dir, atm_dir, months=None):
+        files = []
+        for month in self.months if months is None else months:
+            for w, wkd in enumerate(DAYTYPE):
+                for hr in range(HOURS):
+                    if not self.is_written(month, w == 0, hr):
+                        continue
+                    aam, atm = self.to_frames(month, w == 0, hr)
+                    aam_path = os.path.join(aam_dir, f'aam-{month}-{wkd}-{hr}.csv')
+                    atm_path = os.path.join(atm_dir, f'atm-{month}-{wkd}-{hr}.csv')
+                    aam.to_csv(aam_path, na_rep='NA', line_terminator='\n')
+                    atm.to_csv(atm_path, na_rep='NA', line_terminator='\n')
+                    files += [aam_path, atm_path]
+        return files
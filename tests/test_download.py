@@ -0,0 +1,133 @@
+import http.server
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import util  # noqa: E402
+
+BODY = bytes(range(256)) * 64
+NAME = 'yellow_tripdata_2019-03.csv'
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    # serves BODY, honouring Range unless ignore_range; short_read cuts the first GET off after that many bytes
+    ignore_range = False
+    short_read = None
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+
+    def do_GET(self):
+        requested = self.headers.get('Range')
+        type(self).ranges.append(requested)
+        start = 0
+        if requested is not None and not self.ignore_range:
+            start = int(re.match(r'bytes=(\d+)-', requested).group(1))
+            if start >= len(BODY):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(BODY)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(BODY) - 1}/{len(BODY)}')
+        else:
+            self.send_response(200)
+        body = BODY[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.short_read is not None:
+            body = body[:self.short_read]
+            type(self).short_read = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'LOG', str(tmp_path / 'download.log'))
+    monkeypatch.setattr(RangeHandler, 'ignore_range', False)
+    monkeypatch.setattr(RangeHandler, 'short_read', None)
+    monkeypatch.setattr(RangeHandler, 'ranges', [])
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/{NAME}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(url, target_dir):
+    # a fresh session each time, so no connection outlives a cut-off response
+    return util.download_file(url, str(target_dir), session=util.requests.Session(), chunk_size=1024)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download(server, tmp_path):
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == [None]
+    assert not os.path.exists(tmp_path / f'{NAME}.part')
+
+
+def test_resume(server, tmp_path):
+    with open(tmp_path / f'{NAME}.part', 'wb') as f:
+        f.write(BODY[:5000])
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == ['bytes=5000-']
+
+
+def test_resume_truncated(server, tmp_path):
+    # a complete-looking file shorter than the remote one is continued, not kept
+    with open(tmp_path / NAME, 'wb') as f:
+        f.write(BODY[:3000])
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == ['bytes=3000-']
+
+
+def test_range_not_satisfiable(server, tmp_path):
+    # a partial file longer than the remote one is not a prefix of it, the download starts over
+    with open(tmp_path / f'{NAME}.part', 'wb') as f:
+        f.write(BODY + b'stale')
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == [f'bytes={len(BODY) + 5}-', None]
+
+
+def test_short_read(server, tmp_path):
+    RangeHandler.short_read = 4000
+    assert download(server, tmp_path) is None
+    assert not os.path.exists(tmp_path / NAME)
+    # what was written before the cut is kept, and the next attempt picks up where it stopped
+    kept = read(tmp_path / f'{NAME}.part')
+    assert 0 < len(kept) <= 4000 and kept == BODY[:len(kept)]
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == [None, f'bytes={len(kept)}-']
+
+
+def test_range_ignored(server, tmp_path):
+    # a server answering 200 to a Range request sends the whole file, which replaces the partial one
+    RangeHandler.ignore_range = True
+    with open(tmp_path / f'{NAME}.part', 'wb') as f:
+        f.write(b'x' * 5000)
+    assert download(server, tmp_path) == NAME
+    assert read(tmp_path / NAME) == BODY
+    assert RangeHandler.ranges == ['bytes=5000-']
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from od import ODAccumulator  # noqa: E402
+
+
+def make_trips(pairs, hour=8):
+    # one weekday trip per (PU, DO) pair, picked up at hour on Friday 2019-03-01
+    n = len(pairs)
+    return {'PULocationID': np.array([p for p, _ in pairs]), 'DOLocationID': np.array([d for _, d in pairs]),
+            'pickup_weekday': np.full(n, 4), 'pickup_hour': np.full(n, hour), 'pickup_minute': np.full(n, hour * 60),
+            'pickup_day': np.ones(n, dtype='int64'), 'trip_time': np.full(n, 600.), 'trip_distance': np.full(n, 2.)}
+
+
+def test_sparse_matches_dense():
+    # 3 has no pickups in the slice, the trip into it is still observed
+    acc = ODAccumulator([1, 2, 3], period='2019-03').update(make_trips([(1, 3), (1, 2), (2, 1)]))
+    od = acc.to_sparse(True, 8)
+    assert list(zip(od.pu, od.do)) == [(1, 2), (1, 3), (2, 1)]
+    ds, ts, atm = acc.od_counts(True, 8)
+    dense = {(pu, do): n for (pu, do), n in ts.stack().items() if n > 0}
+    assert dense == {(pu, do): n for pu, do, n in zip(od.pu, od.do, od.n_trips)}
+    assert list(od.zones) == [1, 2, 3]
+
+
+def test_sparse_demand_bound():
+    # with a bound, only pairs between pickup zones of more than low_bd trips are kept
+    acc = ODAccumulator([1, 2, 3], period='2019-03').update(make_trips([(1, 3), (1, 2), (1, 2), (2, 1)]))
+    od = acc.to_sparse(True, 8, low_bd=0)
+    assert list(zip(od.pu, od.do)) == [(1, 2), (2, 1)]
+    assert list(od.zones) == [1, 2]
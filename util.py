@@ -1,14 +1,28 @@
 from bs4 import BeautifulSoup
 import requests
+import queue
 import re
-import multiprocessing as mp
+import threading
 import time
 import os
 import sys
 import glob
+import gzip
+import bz2
+import io
+import csv
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stderr
 from itertools import islice
 from typing import TextIO
 
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 URL = "https://nyc-tlc.s3.amazonaws.com/"
 CWD = os.path.dirname(os.path.realpath(__file__))
@@ -19,6 +33,11 @@ DATA_DIR = os.path.join(DEST, 'data')
 LOG_DIR = os.path.join(DEST, 'logs')
 AAM_DIR = os.path.join(DEST, 'data/aam')
 ATM_DIR = os.path.join(DEST, 'data/atm')
+CACHE_DIR = os.path.join(DEST, 'data/cache')
+PARTIAL_DIR = os.path.join(DEST, 'data/partial')
+OD_DIR = os.path.join(DEST, 'data/od')
+DIST_DIR = os.path.join(DEST, 'data/dist')
+QUARANTINE_DIR = os.path.join(DEST, 'logs/quarantine')
 if not os.path.exists(RAW_DIR):
     os.makedirs(RAW_DIR)
 
@@ -31,7 +50,30 @@ if not os.path.exists(AAM_DIR):
 if not os.path.exists(ATM_DIR):
     os.makedirs(ATM_DIR)
 
+if not os.path.exists(CACHE_DIR):
+    os.makedirs(CACHE_DIR)
+
+if not os.path.exists(PARTIAL_DIR):
+    os.makedirs(PARTIAL_DIR)
+
+if not os.path.exists(OD_DIR):
+    os.makedirs(OD_DIR)
+
+if not os.path.exists(DIST_DIR):
+    os.makedirs(DIST_DIR)
+
+if not os.path.exists(QUARANTINE_DIR):
+    os.makedirs(QUARANTINE_DIR)
+
 LOG = os.path.join(LOG_DIR, f'download-{int(time.time())}.log')
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60
+RETRIES = 3
+# trip data files found in a directory, with the codec their csv is compressed with; in this order of
+# preference when a month is there in several forms
+DATA_EXT = {'.csv': None, '.csv.gz': 'gzip', '.csv.zst': 'zstd', '.csv.bz2': 'bz2', '.parquet': 'parquet'}
+
+_local = threading.local()
 
 
 def parse_date_from_filename(fname):
@@ -45,10 +87,24 @@ def parse_date_from_filename(fname):
     return year, month
 
 
+def get_data_ext(file):
+    return next((ext for ext in sorted(DATA_EXT, key=len, reverse=True) if file.endswith(ext)), None)
+
+
+def is_parquet(file):
+    return get_data_ext(file) == '.parquet'
+
+
 def get_csv_file_from_dir(directory, relative=None):
+    # plain, compressed and Parquet trip data, one file per name
     assert os.path.isdir(directory), 'Not a directory or not exist'
     directory = os.path.realpath(directory)
-    files = glob.glob(os.path.join(directory, '*.csv'))
+    files = dict()
+    for ext in DATA_EXT:
+        for f in glob.glob(os.path.join(directory, f'*{ext}')):
+            if get_data_ext(f) == ext:
+                files.setdefault(f[:-len(ext)], f)
+    files = list(files.values())
     if relative is not None:
         files = [os.path.relpath(f, relative) for f in files]
     return files
@@ -70,11 +126,11 @@ def filter_csv_file_by_time(files, **kwargs):
         month = '0' + str(month)
 
     if year is not None and month is not None:
-        parser = re.compile(f'{year}-{month}\.csv')
+        parser = re.compile(rf'{year}-{month}\.(csv|parquet)')
     elif year is not None and month is None:
-        parser = re.compile(f'{year}-\d\d\.csv')
+        parser = re.compile(rf'{year}-\d\d\.(csv|parquet)')
     elif year is None and month is not None:
-        parser = re.compile(f'\d\d\d\d-{month}\.csv')
+        parser = re.compile(rf'\d\d\d\d-{month}\.(csv|parquet)')
     else:
         return
     results = []
@@ -85,6 +141,19 @@ def filter_csv_file_by_time(files, **kwargs):
     return results
 
 
+def filter_csv_file_by_range(files, start: str = None, end: str = None):
+    # files whose 'YYYY-MM' lies in [start, end], either bound may be omitted
+    results = []
+    for ff in files:
+        try:
+            year, month = parse_date_from_filename(ff)
+        except ValueError:
+            continue
+        if (start is None or f'{year}-{month}' >= start) and (end is None or f'{year}-{month}' <= end):
+            results.append(ff)
+    return results
+
+
 def read_parser_error(error):
     error = str(error)
     par = re.compile(r'Expected\s(?P<expect>\d+)\sfields\sin\sline\s(?P<line>\d+),\ssaw\s(?P<saw>\d+)')
@@ -98,8 +167,66 @@ def read_parser_error(error):
     return res
 
 
+def open_data(file: str, mode='rb'):
+    # a stream decompressing file as it is read, so a compressed month is never written out whole
+    codec = DATA_EXT.get(get_data_ext(file))
+    if codec == 'gzip':
+        return gzip.open(file, mode)
+    if codec == 'bz2':
+        return bz2.open(file, mode)
+    if codec == 'zstd':
+        assert zstandard is not None, f'reading {file} needs the zstandard package'
+        return zstandard.open(file, mode)
+    assert codec is None, f'{file} is not a csv file'
+    return open(file, mode)
+
+
+class FieldCheck(io.RawIOBase):
+    # a binary stream passed through as the parser reads it, flagging lines with more commas than the header has;
+    # commas inside quotes are counted too, so a flagged file is confirmed with find_long_line
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.expect = None
+        self.carry = 0
+        self.long = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        block = self.stream.read(len(buffer))
+        data = np.frombuffer(block, dtype=np.uint8)
+        commas = np.flatnonzero(data == ord(','))
+        ends = np.searchsorted(commas, np.flatnonzero(data == ord('\n')))
+        if len(ends) > 0:
+            counts = np.diff(ends, prepend=0)
+            counts[0] += self.carry
+            if self.expect is None:
+                self.expect, counts = counts[0], counts[1:]
+            self.long = self.long or bool((counts > self.expect).any())
+            self.carry = len(commas) - ends[-1]
+        else:
+            self.carry += len(commas)
+            # the last line may not end with a newline
+            self.long = self.long or (len(block) < 1 and self.expect is not None and self.carry > self.expect)
+        buffer[:len(block)] = block
+        return len(block)
+
+
+@contextmanager
+def open_csv(file: str, check=False):
+    # what read_csv reads file from: its path when plain, so pandas reads it natively, else a decompressing stream;
+    # with check, the stream is read through a FieldCheck, whose flag is source.raw.long
+    if DATA_EXT.get(get_data_ext(file)) is None and not check:
+        yield file
+        return
+    with open_data(file, 'rb') as f:
+        yield io.BufferedReader(FieldCheck(f)) if check else f
+
+
 def handle_parser_error(file: str, err_info: dict):
-    file = open(file, 'r')
+    file = open_data(file, 'rt')
     lineno = read_parser_error(err_info).pop('line')
     try:
         line = next(islice(file, lineno-1, lineno))
@@ -110,6 +237,98 @@ def handle_parser_error(file: str, err_info: dict):
     return line
 
 
+def count_fields(line):
+    return line.count(',') + 1 if '"' not in line else len(next(csv.reader([line])))
+
+
+def find_long_line(file: str):
+    # the first line with more fields than the header
+    with open_data(file, 'rt') as src:
+        expect = count_fields(next(src))
+        for line in src:
+            if count_fields(line) > expect:
+                return line
+
+
+def read_skipped_lines(message):
+    par = re.compile(r'Skipping\sline\s(?P<line>\d+):\sexpected\s(?P<expect>\d+)\sfields,\ssaw\s(?P<saw>\d+)')
+    return [{'line': int(se.group('line')), 'expect': int(se.group('expect')), 'saw': int(se.group('saw'))}
+            for se in par.finditer(message)]
+
+
+class Quarantine:
+    # lines of file the C parser skipped as malformed, copied with their line numbers to quarantine_dir, the
+    # lines with too few fields, which the parser pads with NaN instead of skipping, and the rows whose
+    # timestamps could not be read, which are dropped in cleaning
+    def __init__(self, file: str, quarantine_dir=None):
+        if quarantine_dir is None:
+            quarantine_dir = QUARANTINE_DIR
+        self.file = file
+        self.path = os.path.join(quarantine_dir, f'{os.path.basename(file)}.bad')
+        self.skipped = []
+        self.short = []
+        # positions of the rows among those the parser returned, until write() finds their lines
+        self.rows = set()
+        self.unreadable = []
+
+    def __len__(self):
+        return len(self.skipped) + len(self.short) + len(self.unreadable)
+
+    def add_rows(self, rows):
+        self.rows.update(int(r) for r in rows)
+
+    @contextmanager
+    def capture(self):
+        # the parser reports each skipped line on stderr, or as a ParserWarning from pandas 2.2 on
+        err = io.StringIO()
+        try:
+            with redirect_stderr(err), warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                yield self
+        finally:
+            self.skipped.extend(read_skipped_lines(err.getvalue()))
+            for w in caught:
+                skipped = read_skipped_lines(str(w.message))
+                if len(skipped) > 0:
+                    self.skipped.extend(skipped)
+                else:
+                    warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+
+    def write(self):
+        # one pass over file, which also finds the short lines the parser gave no notice of, and the lines of the
+        # added rows, counting the lines the parser returned a row for
+        wanted = {s['line']: dict(s, reason='long') for s in self.skipped}
+        self.short, self.unreadable = [], []
+        tmp_path = f'{self.path}.tmp-{os.getpid()}'
+        with open_data(self.file, 'rt') as src, open(tmp_path, 'w') as dst:
+            dst.write('line\treason\texpect\tsaw\ttext\n')
+            expect = None
+            row = 0
+            for lineno, line in enumerate(src, start=1):
+                saw = count_fields(line)
+                if expect is None:
+                    expect = saw
+                    continue
+                if lineno in wanted or not line.strip():
+                    pass
+                elif saw < expect:
+                    wanted[lineno] = {'line': lineno, 'expect': expect, 'saw': saw, 'reason': 'short'}
+                    self.short.append(wanted[lineno])
+                elif row in self.rows:
+                    wanted[lineno] = {'line': lineno, 'expect': expect, 'saw': saw, 'reason': 'timestamp'}
+                    self.unreadable.append(wanted[lineno])
+                if line.strip() and wanted.get(lineno, {}).get('reason') != 'long':
+                    row += 1
+                if lineno in wanted:
+                    w = wanted[lineno]
+                    dst.write(f'{lineno}\t{w["reason"]}\t{w["expect"]}\t{w["saw"]}\t{line.rstrip()}\n')
+        if len(wanted) < 1:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, self.path)
+        return self.path
+
+
 def set_destination(dest):
     global RAW_DIR
     if dest is None:
@@ -123,7 +342,7 @@ def set_destination(dest):
 
 
 def get_download_path(source):
-    html = requests.get(source).text
+    html = get_session().get(source, timeout=TIMEOUT).text
     soup = BeautifulSoup(html, 'lxml')
     csv_url = soup.find_all('key')
 
@@ -136,51 +355,146 @@ def get_download_path(source):
         z = zone_parser.search(csv.text)
         if z is not None:
             zone_path = z.string.split(' ')
-            zone_path = URL + '+'.join(zone_path)
+            zone_path = source + '+'.join(zone_path)
         if s is not None:
             seg = s.string.split(' ')
             seg = '+'.join(seg)
-            csv_path.append(URL + seg)
+            csv_path.append(source + seg)
     return csv_path, zone_path
 
 
-def download_file(url, target_dir):
+def get_session():
+    # one pooled session per thread, connections are reused across files
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(max_retries=RETRIES)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def get_remote_size(url, session=None):
+    session = get_session() if session is None else session
+    try:
+        file = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException:
+        return
+    if file.status_code != 200 or 'Content-Length' not in file.headers:
+        return
+    return int(file.headers['Content-Length'])
+
+
+def _get_total_size(file, offset):
+    if file.status_code == 206:
+        content_range = file.headers.get('Content-Range', '')
+        total = content_range.split('/')[-1]
+        return int(total) if total.isdigit() else None
+    if 'Content-Length' in file.headers:
+        return offset + int(file.headers['Content-Length'])
+    return
+
+
+def download_file(url, target_dir, session=None, chunk_size=CHUNK_SIZE):
     name = url.split('/')[-1]
     check_path = os.path.join(target_dir, name)
+    part_path = check_path + '.part'
+    session = get_session() if session is None else session
     if os.path.isfile(check_path) and os.path.getsize(check_path) > 0:
-        print(name + '...Exists')
-        return name
-    print(name + '...Started')
-    file = requests.get(url, stream=False)
+        remote_size = get_remote_size(url, session)
+        if remote_size is None or remote_size == os.path.getsize(check_path):
+            print(name + '...Exists')
+            return name
+        # left truncated by an earlier run, continue it as a partial download
+        os.replace(check_path, part_path)
+
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+    print(name + (f'...Resumed at {offset}' if offset > 0 else '...Started'))
     try:
-        assert file.status_code == 200
-    except AssertionError:
+        with session.get(url, stream=True, headers=headers, timeout=TIMEOUT) as file:
+            if file.status_code == 416 and offset > 0:
+                # the partial file is not a prefix of the remote one, start over
+                os.remove(part_path)
+                return download_file(url, target_dir, session, chunk_size)
+            if file.status_code not in (200, 206):
+                with open(LOG, 'a') as f:
+                    f.write(name + f'...not downloaded: {file.status_code}-{file.reason}\n')
+                return
+            if file.status_code == 200:
+                offset = 0
+            total = _get_total_size(file, offset)
+            with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in file.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            raise IncompleteDownloadError(f'expected {total} bytes, got {size}')
+        os.replace(part_path, check_path)
+    except Exception as err:
         with open(LOG, 'a') as f:
-            f.write(name + f'...not downloaded: {file.status_code}-{file.reason}\n')
-    else:
-        try:
-            with open(os.path.join(target_dir, name), 'wb') as f:
-                f.write(file.content)
-        except Exception as err:
-            with open(LOG, 'a') as f:
-                f.write(name + f'...{sys.exc_info()[0]}: {err}\n')
-            print(name + f'...{sys.exc_info()[0]}: {err}')
-        else:
-            print(name + '...OK')
-        return name
+            f.write(name + f'...{sys.exc_info()[0]}: {err}\n')
+        print(name + f'...{sys.exc_info()[0]}: {err}')
+        return
+    print(name + '...OK')
+    return name
 
 
-def download_file_parallel(num_core, destination=None):
+def download_file_parallel(num_core, destination=None, source=URL):
     if destination is not None:
         set_destination(destination)
-    csv_path, zone_path = get_download_path(URL)
+    csv_path, zone_path = get_download_path(source)
     zone_name = download_file(zone_path, DATA_DIR)
 
-    item = [(csv, RAW_DIR) for csv in csv_path]
-    with mp.Pool(num_core) as pool:
-        data_names = pool.starmap(download_file, item)
+    # downloads are I/O bound, threads share the process and its connection pools
+    with ThreadPoolExecutor(num_core) as pool:
+        data_names = list(pool.map(lambda csv: download_file(csv, RAW_DIR), csv_path))
+
+    return [n for n in data_names if n is not None], zone_name
+
+
+class DownloadQueue:
+    # iterate to get file names as their downloads finish; at most max_pending files may be
+    # downloading or waiting for release(), which bounds the disk used ahead of the consumer
+    def __init__(self, urls, target_dir, num_threads, max_pending):
+        assert max_pending > 0, f'invalid max_pending={max_pending}'
+        self._target_dir = target_dir
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._done = queue.Queue()
+        self._pool = ThreadPoolExecutor(num_threads)
+        self._count = len(urls)
+        self.names = [url.split('/')[-1] for url in urls]
+        for url in urls:
+            self._pool.submit(self._download, url)
+
+    def _download(self, url):
+        self._slots.acquire()
+        name = None
+        try:
+            name = download_file(url, self._target_dir)
+        finally:
+            if name is None:
+                self._slots.release()
+            self._done.put(name)
+
+    def __iter__(self):
+        for _ in range(self._count):
+            name = self._done.get()
+            if name is not None:
+                yield name
+        self._pool.shutdown()
+
+    def release(self, *args):
+        self._slots.release()
 
-    return data_names, zone_name
+
+def download_file_pipeline(num_core, max_pending, destination=None, source=URL):
+    if destination is not None:
+        set_destination(destination)
+    csv_path, zone_path = get_download_path(source)
+    zone_name = download_file(zone_path, DATA_DIR)
+    return DownloadQueue(csv_path, RAW_DIR, num_core, max_pending), zone_name
 
 
 class ColumnNotFoundError(KeyError):
@@ -191,6 +505,10 @@ class BadLineError(ValueError):
     pass
 
 
+class IncompleteDownloadError(IOError):
+    pass
+
+
 if __name__ == '__main__':
     rt = get_download_path(URL)
     sep_14 = filter_csv_file_by_time(rt[0], year=2014, month=9)
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import get_fingerprint
+
+_loaded = dict()
+
+
+class ZoneIndex:
+    # LocationID -> borough code array, so a borough test is one gather instead of an isin per call.
+    # codes covers every uint16 ID, which lets the cleaned uint16 zone columns index it without bound checks
+    def __init__(self, groups: dict):
+        self.boroughs = sorted(str(b) for b in groups)
+        self._code = {b: i for i, b in enumerate(self.boroughs)}
+        assert len(self.boroughs) < 128, 'too many boroughs for an int8 code'
+        ids = {b: np.array(sorted(int(z) for z in groups[b]), dtype='int64') for b in groups}
+        size = max([1 << 16] + [int(z[-1]) + 1 for z in ids.values() if len(z) > 0])
+        self.codes = np.full(size, -1, dtype='int8')
+        self._zones = dict()
+        for b, z in ids.items():
+            self.codes[z] = self._code[str(b)]
+            self._zones[str(b)] = z
+
+    @classmethod
+    def from_table(cls, table: pd.DataFrame):
+        for c in ['LocationID', 'Borough']:
+            assert c in table.columns, f'{c} is not in the table'
+        return cls({b: z.to_numpy() for b, z in table.groupby(by='Borough')['LocationID']})
+
+    @classmethod
+    def from_file(cls, file):
+        return cls.from_table(pd.read_csv(file, low_memory=False, index_col=False))
+
+    def keys(self):
+        return list(self.boroughs)
+
+    def __contains__(self, location):
+        return location in self._code
+
+    def __getitem__(self, location):
+        return self.zones(location)
+
+    def zones(self, location: str):
+        assert location in self, f'Unknown location: {location}, must be in {self.keys()}'
+        return self._zones[location]
+
+    def code(self, location: str):
+        assert location in self, f'Unknown location: {location}, must be in {self.keys()}'
+        return self._code[location]
+
+    def mask(self, ids, location: str):
+        code = self.code(location)
+        ids = np.asarray(ids)
+        if ids.dtype in (np.uint8, np.uint16):
+            return self.codes[ids] == code
+        if ids.dtype.kind == 'f':
+            ids = np.where(np.isnan(ids), -1, ids)
+        ids = ids.astype('int64')
+        known = (ids >= 0) & (ids < len(self.codes))
+        result = np.zeros(len(ids), dtype=bool)
+        result[known] = self.codes[ids[known]] == code
+        return result
+
+
+def register_zone_index(file, index: ZoneIndex):
+    # seeds this process' cache, e.g. from a pool initializer, so workers never parse the table themselves
+    _loaded[os.path.realpath(file)] = (get_fingerprint(file), index)
+
+
+def load_zone_index(file):
+    key = os.path.realpath(file)
+    fingerprint = get_fingerprint(file)
+    if key not in _loaded or _loaded[key][0] != fingerprint:
+        _loaded[key] = (fingerprint, ZoneIndex.from_file(file))
+    return _loaded[key][1]